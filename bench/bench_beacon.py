@@ -0,0 +1,132 @@
+"""
+Benchmark the batch interval histograms of flare/beacon_engine.py against
+the per-pair groupby loop the detectors used before.
+
+Usage: python bench/bench_beacon.py [--pairs N] [--emails-per-pair M]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/flare")
+from beacon_engine import NS_PER_SECOND, best_windows, epoch_nanoseconds, interval_histograms
+
+MIN_OCCUR = 10
+MIN_PERCENT = 5
+MIN_INTERVAL = 2
+WINDOW = 2
+
+
+def percent_grouping(delta_counts, total):
+    # flare.py EmailBeaconDetector._percent_grouping
+    max_percent = 0
+    best_interval = 0
+    keys = sorted(delta_counts.keys())
+    for i in range(len(keys) - WINDOW + 1):
+        window_keys = keys[i:i + WINDOW]
+        current = sum([delta_counts[k] for k in window_keys])
+        percent = (current / total) * 100
+        if percent > max_percent:
+            max_percent = percent
+            best_interval = window_keys[WINDOW // 2]
+    return best_interval, max_percent
+
+
+def groupby_loop(data):
+    # flare.py EmailBeaconDetector.detect_beaconing before the batch engine
+    df = data.copy()
+    df["pair_id"] = (df["email.sender"] + df["email.receiver"]).apply(hash)
+    df["@timestamp"] = pd.to_datetime(df["@timestamp"])
+    results = []
+    for pair_id, group in df.groupby("pair_id"):
+        group = group.sort_values("@timestamp")
+        group["delta"] = (
+            group["@timestamp"].diff().dt.total_seconds().fillna(0).astype(int)
+        )
+        group = group[group["delta"] >= MIN_INTERVAL]
+        if group.empty:
+            continue
+        delta_counts = group["delta"].value_counts().to_dict()
+        total = sum(delta_counts.values())
+        if total < MIN_OCCUR:
+            continue
+        interval, percent = percent_grouping(delta_counts, total)
+        if percent > MIN_PERCENT:
+            results.append({
+                "sender": group["email.sender"].iloc[0],
+                "receiver": group["email.receiver"].iloc[0],
+                "interval_seconds": interval,
+                "beacon_percent": percent,
+                "event_count": total,
+            })
+    return pd.DataFrame(results)
+
+
+def batch_engine(data):
+    # flare.py EmailBeaconDetector.detect_beaconing with the batch engine
+    pair_id = (data["email.sender"] + data["email.receiver"]).apply(hash)
+    codes, _ = pd.factorize(pair_id, sort=True)
+    hist = interval_histograms(codes, epoch_nanoseconds(data["@timestamp"]),
+                               MIN_INTERVAL, NS_PER_SECOND, keep_first=True)
+    interval, percent = best_windows(hist, WINDOW, "keys")
+    beacon = (hist.totals >= MIN_OCCUR) & (percent > MIN_PERCENT)
+    rows = hist.first_rows[beacon]
+    return pd.DataFrame({
+        "sender": data["email.sender"].to_numpy()[rows],
+        "receiver": data["email.receiver"].to_numpy()[rows],
+        "interval_seconds": interval[beacon],
+        "beacon_percent": percent[beacon],
+        "event_count": hist.totals[beacon],
+    })
+
+
+def make_emails(pairs, per_pair, seed=0):
+    """Emails of random pairs, a tenth of them beaconing with jitter."""
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2025-01-01T00:00:00", "ns").astype(np.int64)
+    pair = np.repeat(np.arange(pairs), per_pair)
+    beacon = pair % 10 == 0
+    period = rng.integers(60, 3600, pairs)[pair]
+    step = np.where(beacon, period + rng.integers(-1, 2, len(pair)),
+                    rng.integers(1, 7200, len(pair)))
+    # Cumulative steps per pair, not across pairs
+    offsets = np.cumsum(step)
+    offsets -= np.repeat(offsets[::per_pair] - step[::per_pair], per_pair)
+    stamps = start + offsets * NS_PER_SECOND
+    order = rng.permutation(len(pair))
+    return pd.DataFrame({
+        "email.sender": [f"sender{p % 997}@corp.example" for p in pair[order]],
+        "email.receiver": [f"rcpt{p}@ext.example" for p in pair[order]],
+        "@timestamp": stamps[order].astype("datetime64[ns]"),
+    })
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=20000)
+    parser.add_argument("--emails-per-pair", type=int, default=50)
+    args = parser.parse_args()
+
+    data = make_emails(args.pairs, args.emails_per_pair)
+    print(f"{len(data)} emails, {args.pairs} pairs")
+    expected, loop_time = timed(groupby_loop, data)
+    actual, engine_time = timed(batch_engine, data)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+    print(f"groupby loop: {loop_time:.2f}s")
+    print(f"batch engine: {engine_time:.2f}s")
+    print(f"{len(actual)} beacons, identical, speedup {loop_time / engine_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark the compiled FieldPlan against the per-field AlertFormatter.
+
+Usage: python bench/bench_formatter.py [--alerts N] [--keys data/keys.txt]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/code")
+from AlertProcessor import AlertFormatter, FieldPlan
+
+DEFAULT_KEYS = [
+    "_id",
+    "@timestamp",
+    "kibana.alert.rule.name",
+    "kibana.alert.rule.description",
+    "kibana.alert.severity",
+    "kibana.alert.risk_score",
+    "kibana.alert.reason",
+    "kibana.alert.rule.threat.tactic.name",
+    "kibana.alert.rule.threat.technique.id",
+    "kibana.alert.rule.threat.technique.name",
+    "kibana.alert.rule.threat.technique.subtechnique.name",
+    "host.name",
+    "host.os.name",
+    "host.ip",
+    "user.name",
+    "user.domain",
+    "process.name",
+    "process.command_line",
+    "process.executable",
+    "process.parent.name",
+    "process.parent.command_line",
+    "process.hash.sha256",
+    "file.path",
+    "source.ip",
+    "destination.ip",
+    "destination.port",
+    "event.action",
+    "event.category",
+]
+
+
+def make_alert(rnd: random.Random) -> dict:
+    """
+    Build a synthetic alert shaped like a .internal.alerts-security document.
+    """
+    return {
+        "@timestamp": f"2025-06-0{rnd.randint(1, 9)}T12:00:00.000Z",
+        "kibana.alert.rule.name": f"Rule {rnd.randint(0, 50)}",
+        "kibana.alert.rule.description": "Detects suspicious activity " * 4,
+        "kibana.alert.severity": rnd.choice(["low", "medium", "high"]),
+        "kibana.alert.risk_score": rnd.uniform(0, 100),
+        "kibana.alert.reason": "process event with process powershell.exe",
+        "kibana.alert.rule.threat": [
+            {
+                "framework": "MITRE ATT&CK",
+                "tactic": {"id": "TA0002", "name": "Execution"},
+                "technique": [
+                    {
+                        "id": "T1059",
+                        "name": "Command and Scripting Interpreter",
+                        "subtechnique": [{"id": "T1059.001", "name": "PowerShell"}],
+                    }
+                ],
+            }
+        ],
+        "host": {
+            "name": f"host-{rnd.randint(0, 20)}",
+            "os": {"name": "Windows"},
+            "ip": ["10.0.0.1", "fe80::1"],
+        },
+        "user": {"name": f"user{rnd.randint(0, 30)}", "domain": "CORP"},
+        "process": {
+            "name": "powershell.exe",
+            "command_line": "powershell.exe -enc " + "A" * 64,
+            "executable": "C:\\Windows\\System32\\powershell.exe",
+            "parent": {"name": "cmd.exe", "command_line": "cmd.exe /c run.bat"},
+            "hash": {"sha256": "%064x" % rnd.getrandbits(256)},
+        },
+        "source": {"ip": "10.0.0.2"},
+        "destination": {"ip": "10.0.0.3", "port": 443},
+        "event": {"action": "start", "category": ["process"]},
+    }
+
+
+def pad_alert(alert: dict, padding: int) -> dict:
+    """
+    Add unused flattened fields, as found on real alerts.
+    """
+    for i in range(padding):
+        alert[f"kibana.alert.original_event.field_{i}"] = "x" * 32
+    return alert
+
+
+def load_keys(path: str) -> list:
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f]
+    return DEFAULT_KEYS
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark alert formatting.")
+    parser.add_argument("--alerts", type=int, default=5000)
+    parser.add_argument("--padding", type=int, default=200)
+    parser.add_argument("--keys", type=str, default="data/keys.txt")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    keys = load_keys(args.keys)
+    alerts = [pad_alert(make_alert(rnd), args.padding) for _ in range(args.alerts)]
+    for i, alert in enumerate(alerts):
+        alert["_id"] = f"alert-{i}"
+
+    start = time.perf_counter()
+    legacy = [AlertFormatter(alert, fields=keys).format() for alert in alerts]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plan = FieldPlan(keys)
+    compiled = [plan.format(alert) for alert in alerts]
+    compiled_time = time.perf_counter() - start
+
+    assert legacy == compiled, "FieldPlan output differs from AlertFormatter"
+
+    print(f"alerts: {len(alerts)}, keys: {len(keys)}")
+    print(f"AlertFormatter: {legacy_time:.3f}s")
+    print(f"FieldPlan:      {compiled_time:.3f}s")
+    print(f"speedup:        {legacy_time / compiled_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+Replay recorded chat completion requests through the mitmproxy addon chain
+against a local stub LLM, and measure what the proxy adds.
+
+Each run first replays the requests straight to the stub, then through
+`mitmdump -s run_addons.py -m reverse:<stub>`, and reports the latency
+percentiles of both, the latency added by the proxy, the throughput and
+the memory growth of mitmdump.
+
+Usage: python bench/proxy_replay.py data/requests.jsonl [--rate 20]
+    [--concurrency 8] [--requests 500] [--tokens 50] [--token-rate 200]
+
+The recordings are NDJSON, either request bodies or DumpBody records
+with a "request" key. Every replayed request gets a unique message, so
+the completion cache and the coalescer do not hide the chain's cost,
+unless --allow-cache is set.
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATH = "/v1beta/openai/chat/completions"
+
+
+def load_requests(paths: List[str]) -> List[Dict[str, Any]]:
+    bodies = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                body = record.get("request", record)
+                if isinstance(body, dict) and "messages" in body:
+                    bodies.append(body)
+    return bodies
+
+
+def stub_server(port: int, tokens: int, token_rate: float) -> ThreadingHTTPServer:
+    """OpenAI compatible server generating `tokens` deltas at `token_rate`/s.
+
+    Like a real backend, it only streams if the request asks for it, so
+    a proxy dropping "stream" shows up as zero streamed responses.
+    """
+    chunk = {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "model": "stub",
+        "choices": [{"index": 0, "delta": {"content": "tok "}}],
+    }
+    event = b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+    completion = {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "model": "stub",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": "tok " * tokens},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+    delay = 1 / token_rate if token_rate > 0 else 0
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                stream = bool(json.loads(body).get("stream"))
+            except (ValueError, AttributeError):
+                stream = False
+            if not stream:
+                time.sleep(delay * tokens)
+                data = json.dumps(completion).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for _ in range(tokens):
+                self._chunk(event)
+                time.sleep(delay)
+            self._chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _chunk(self, data: bytes) -> None:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def send(port: int, body: bytes) -> Dict[str, Any]:
+    """POST one request and time the first byte and the end of the body."""
+    start = time.perf_counter()
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        connection.request(
+            "POST",
+            PATH,
+            body,
+            {"Content-Type": "application/json", "Authorization": "Bearer stub"},
+        )
+        response = connection.getresponse()
+        first = response.read(1)
+        ttfb = time.perf_counter() - start
+        size = len(first) + len(response.read())
+        return {
+            "status": response.status,
+            "ttfb": ttfb,
+            "total": time.perf_counter() - start,
+            "bytes": size,
+            "streamed": response.getheader("Content-Type", "").startswith(
+                "text/event-stream"
+            ),
+        }
+    finally:
+        connection.close()
+
+
+def replay(
+    port: int, bodies: List[bytes], rate: float, concurrency: int
+) -> Dict[str, Any]:
+    """Send the bodies open loop at `rate`/s with at most `concurrency` in flight."""
+    results: List[Dict[str, Any]] = []
+    errors = 0
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def run(i: int, body: bytes) -> None:
+        nonlocal errors
+        if rate > 0:
+            time.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        try:
+            result = send(port, body)
+        except (OSError, http.client.HTTPException):
+            with lock:
+                errors += 1
+            return
+        with lock:
+            if result["status"] == 200:
+                results.append(result)
+            else:
+                errors += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, body in enumerate(bodies):
+            pool.submit(run, i, body)
+    elapsed = time.perf_counter() - start
+    return {"results": results, "errors": errors, "elapsed": elapsed}
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": float("nan"), "p90": float("nan"), "p99": float("nan")}
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99)}
+
+
+def report(name: str, run: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    results = run["results"]
+    ttfb = percentiles([r["ttfb"] for r in results])
+    total = percentiles([r["total"] for r in results])
+    print(
+        f"{name:>8}: {len(results)} ok, {run['errors']} errors, "
+        f"{sum(r['streamed'] for r in results)} streamed, "
+        f"{len(results) / run['elapsed']:.1f} req/s, "
+        f"{sum(r['bytes'] for r in results) / run['elapsed'] / 1024:.0f} KiB/s"
+    )
+    for label, p in (("ttfb", ttfb), ("total", total)):
+        print(
+            f"{'':>10}{label:<6} p50 {p['p50'] * 1000:8.1f}ms  "
+            f"p90 {p['p90'] * 1000:8.1f}ms  p99 {p['p99'] * 1000:8.1f}ms"
+        )
+    return {"ttfb": ttfb, "total": total}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("recordings", nargs="+", help="NDJSON files of requests")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=20, help="Requests per second")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=50, help="Deltas per response")
+    parser.add_argument(
+        "--token-rate", type=float, default=200, help="Deltas per second"
+    )
+    parser.add_argument("--script", default=os.path.join(REPO, "run_addons.py"))
+    parser.add_argument("--allow-cache", action="store_true")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        help="MAX_CONCURRENCY of the admission control, defaults to --concurrency",
+    )
+    args = parser.parse_args()
+    # Below the client concurrency, admission queueing shows up as overhead
+    max_concurrency = args.max_concurrency or args.concurrency
+
+    recorded = load_requests(args.recordings)
+    if not recorded:
+        sys.exit("No requests found in the recordings")
+    run_id = uuid.uuid4().hex
+    bodies = []
+    for i in range(args.requests):
+        body = dict(recorded[i % len(recorded)])
+        if not args.allow_cache:
+            nonce = {"role": "user", "content": f"replay {run_id} {i}"}
+            body["messages"] = list(body["messages"]) + [nonce]
+        bodies.append(json.dumps(body).encode("utf-8"))
+    print(
+        f"Replaying {len(bodies)} requests from {len(recorded)} recorded, "
+        f"{args.rate}/s, concurrency {args.concurrency}, "
+        f"{args.tokens} deltas at {args.token_rate}/s, "
+        f"admission max concurrency {max_concurrency}"
+    )
+
+    stub_port, proxy_port = free_port(), free_port()
+    stub = stub_server(stub_port, args.tokens, args.token_rate)
+    direct = report("direct", replay(stub_port, bodies, args.rate, args.concurrency))
+
+    # Dumps and caches of the addons go to a scratch directory
+    workdir = tempfile.mkdtemp(prefix="proxy_replay-")
+    env = dict(
+        os.environ,
+        METRICS_PORT=str(free_port()),
+        LLM_BACKENDS="",
+        MAX_CONCURRENCY=str(max_concurrency),
+    )
+    try:
+        proxy = subprocess.Popen(
+            [
+                "mitmdump",
+                "-q",
+                "-s",
+                args.script,
+                "-m",
+                f"reverse:http://127.0.0.1:{stub_port}@{proxy_port}",
+            ],
+            cwd=workdir,
+            env=env,
+        )
+    except FileNotFoundError:
+        sys.exit("mitmdump not found, install it with `pip install mitmproxy`")
+    try:
+        wait_for_port(proxy_port)
+        # Warm up imports and connections before taking the baseline
+        replay(proxy_port, bodies[: args.concurrency], 0, args.concurrency)
+        rss_start = rss_bytes(proxy.pid)
+        rss_peak = rss_start or 0
+        sampling = True
+
+        def sample() -> None:
+            nonlocal rss_peak
+            while sampling:
+                rss_peak = max(rss_peak, rss_bytes(proxy.pid) or 0)
+                time.sleep(0.2)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        proxied = report(
+            "proxied", replay(proxy_port, bodies, args.rate, args.concurrency)
+        )
+        sampling = False
+        sampler.join()
+        rss_end = rss_bytes(proxy.pid)
+    finally:
+        proxy.terminate()
+        proxy.wait(timeout=30)
+        stub.shutdown()
+
+    print("proxy added:")
+    for label in ("ttfb", "total"):
+        added = {q: proxied[label][q] - direct[label][q] for q in direct[label]}
+        print(
+            f"{'':>10}{label:<6} p50 {added['p50'] * 1000:8.1f}ms  "
+            f"p90 {added['p90'] * 1000:8.1f}ms  p99 {added['p99'] * 1000:8.1f}ms"
+        )
+    if rss_start and rss_end:
+        mib = 1024 * 1024
+        print(
+            f"mitmdump rss: {rss_start / mib:.1f} MiB -> {rss_end / mib:.1f} MiB "
+            f"(peak {rss_peak / mib:.1f} MiB, "
+            f"{(rss_end - rss_start) / len(bodies) / 1024:.2f} KiB/request)"
+        )
+    print(f"Proxy dumps and caches in {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,127 @@
 import json
-from typing import Any, Dict, List, Union
+from FileManager import FileManager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+FIELD_THREAT = "kibana.alert.rule.threat"
+ALERT_PREFIX = "kibana.alert."
+
+
+def leaf_value(d: Any) -> Union[str, int]:
+    """
+    Convert the value found at the end of a key path into
+    its printable form.
+
+    :param d: The value at the end of the key path.
+    :return: The value if of type str or int, floats as int,
+    lists joined by commas, otherwise an empty string.
+    """
+    if isinstance(d, (str, int)):
+        return d
+    if isinstance(d, float):
+        return int(d)
+    elif isinstance(d, list):
+        return ", ".join(str(item) for item in d)
+
+    return ""
+
+
+class _PathNode:
+    """
+    A node in the prefix tree of key path segments.
+    """
+
+    __slots__ = ("children", "terminals")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_PathNode"] = {}
+        self.terminals: List[int] = []
+
+    def insert(self, segments: List[str], index: int) -> None:
+        node = self
+        for segment in segments:
+            node = node.children.setdefault(segment, _PathNode())
+        node.terminals.append(index)
+
+
+class FieldPlan:
+    """
+    A compiled accessor plan for a list of dotted key paths.
+
+    The key list is split once into a prefix tree of path segments,
+    so formatting an alert walks each shared prefix only once and
+    never copies the alert.
+    """
+
+    def __init__(self, fields: List[str]) -> None:
+        """
+        Compile the fields into a reusable accessor plan.
+
+        :param fields: A list of fields to include in the output.
+        """
+        self.fields = list(fields)
+        self.labels: List[str] = []
+        self.root = _PathNode()
+        self.threat_root = _PathNode()
+
+        for index, field in enumerate(self.fields):
+            if field.startswith(FIELD_THREAT):
+                # Nested fields under "kibana.alert.rule.threat" are
+                # resolved relative to the threat subtree
+                nested_field = field[len(FIELD_THREAT) + 1 :]
+                self.threat_root.insert(nested_field.split("."), index)
+            else:
+                self.root.insert(field.split("."), index)
+
+            if field.startswith("kibana.alert"):
+                # Remove the prefix "kibana.alert."
+                self.labels.append(field[len(ALERT_PREFIX) :])
+            else:
+                self.labels.append(field)
+
+    def _walk(self, d: Any, node: _PathNode, values: List[Any]) -> None:
+        for index in node.terminals:
+            values[index] = leaf_value(d)
+        if not d or not node.children:
+            # Missing or empty values leave the whole subtree empty
+            return
+
+        if isinstance(d, list):
+            d = d[0] if d else {}
+        if isinstance(d, dict):
+            for segment, child in node.children.items():
+                self._walk(d.get(segment, {}), child, values)
+        # Otherwise the path is broken and the remaining fields stay empty
+
+    def values(self, alert: Dict[str, Any]) -> List[Any]:
+        """
+        Resolve every field of the plan against a single alert.
+
+        :param alert: A dictionary representing a single alert.
+        :return: The values in the order of the fields.
+        """
+        values: List[Any] = [""] * len(self.fields)
+        self._walk(alert, self.root, values)
+        if self.threat_root.children:
+            self._walk(alert.get(FIELD_THREAT, {}), self.threat_root, values)
+
+        # Flattened keys present on the alert take precedence
+        for index, field in enumerate(self.fields):
+            if field in alert:
+                values[index] = alert[field]
+        return values
+
+    def format(self, alert: Dict[str, Any]) -> str:
+        """
+        Format a single alert into CSV-style field-value lines.
+
+        :param alert: A dictionary representing a single alert.
+        :return: A formatted string representing the alert.
+        """
+        return "\n".join(
+            f"{label},{value}"
+            for label, value in zip(self.labels, self.values(alert))
+            if value
+        )
 
 
 class AlertFormatter:
@@ -43,14 +165,7 @@ class AlertFormatter:
                 d = d.get(key, {})
             else:
                 return ""
-        if isinstance(d, (str, int)):
-            return d
-        if isinstance(d, float):
-            return int(d)
-        elif isinstance(d, list):
-            return ", ".join(str(item) for item in d)
-
-        return ""
+        return leaf_value(d)
 
     def format(self) -> str:
         """
@@ -91,16 +206,32 @@ class AlertProcessor:
     A class to process a JSON file of alerts and format each alert.
     """
 
-    def __init__(self, file_path: str, key_path: str) -> None:
+    def __init__(
+        self,
+        file_path: Optional[str],
+        key_path: str,
+        hits: Optional[Iterable[Dict[str, Any]]] = None,
+    ) -> None:
         """
-        Initialize the processor with the path to the alerts JSON file.
+        Initialize the processor with the alerts, either from a file
+        or handed over in memory.
 
-        :param file_path: Path to the alerts JSON file.
+        :param file_path: Path to the alerts JSON or NDJSON file. None to
+        process `hits` or only format hits passed to `format_hits`.
+        :param key_path: Path to the list of keys to include.
+        :param hits: An iterable of search hits, e.g. straight from
+        `ElasticsearchClient.iter_alerts`, used instead of the file.
         """
         self.file_path = file_path
         self.key_path = key_path
-        self.data: Dict[str, Any] = self._load_data()
+        if hits is not None:
+            self.data: Iterable[Dict[str, Any]] = hits
+        elif file_path:
+            self.data = self._load_data()
+        else:
+            self.data = []
         self.keys: List[str] = self._load_keys()
+        self.plan = FieldPlan(self.keys)
 
     def _load_keys(self) -> List[str]:
         """
@@ -111,31 +242,47 @@ class AlertProcessor:
         with open(self.key_path, "r", encoding="utf-8") as f:
             return [line.strip() for line in f]
 
-    def _load_data(self) -> Dict[str, Any]:
+    def _load_data(self) -> Iterable[Dict[str, Any]]:
         """
-        Load and parse the JSON data from the file.
+        Load and parse the JSON data from the file. NDJSON files
+        (.ndjson or .jsonl, optionally .gz) are read lazily.
 
-        :return: A dictionary representing the parsed JSON content.
+        :return: The hits in the parsed JSON content.
         """
+        if self.file_path.endswith((".ndjson", ".jsonl", ".ndjson.gz", ".jsonl.gz")):
+            return FileManager.read_ndjson(self.file_path)
         with open(self.file_path, "r", encoding="utf-8") as f:
             return json.load(f)
 
+    def format_hit(self, hit: Dict[str, Any]) -> str:
+        """
+        Format a single Elasticsearch hit.
+
+        :param hit: A search hit with `_id` and `_source`.
+        :return: The formatted alert string.
+        """
+        alert = hit.get("_source", {})
+        alert["_id"] = hit.get("_id", "")
+        return self.plan.format(alert)
+
+    def format_hits(self, hits: Iterable[Dict[str, Any]]) -> Iterator[str]:
+        """
+        Format hits as they arrive, e.g. from `ElasticsearchClient.iter_alerts`.
+
+        :param hits: An iterable of search hits.
+        :return: A generator of formatted alert strings.
+        """
+        for hit in hits:
+            yield self.format_hit(hit)
+
     def process_alerts(self) -> List[str]:
         """
         Process and format each alert in the JSON data.
+        Hits passed as an iterator are consumed.
 
         :return: A list of formatted alert strings.
         """
-        hits = self.data
-        res = []
-        for hit in hits:
-            alert = hit.get("_source", {})
-            alert["_id"] = hit.get("_id", "")
-            formatter = AlertFormatter(alert, fields=self.keys)
-            # print(formatter.format())
-            # print()  # Spacing between alerts
-            res.append(formatter.format())
-        return res
+        return list(self.format_hits(self.data))
 
     @staticmethod
     def format_prompt(base_prompt: str, alerts: List[str]) -> str:
@@ -0,0 +1,128 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from AlertProcessor import AlertProcessor, leaf_value
+from PromptPacker import PromptPacker
+
+DEFAULT_GROUP_KEYS = [
+    "kibana.alert.rule.uuid",
+    "host.name",
+    "user.name",
+    "kibana.alert.rule.threat.technique.id",
+]
+
+
+def collect_values(d: Any, segments: List[str]) -> List[str]:
+    """
+    Collect every value at the end of a key path, following all list items
+    and both nested and flattened dotted keys.
+
+    :param d: The alert or a subtree of it.
+    :param segments: The remaining segments of the key path.
+    :return: The printable values found, possibly empty.
+    """
+    if isinstance(d, list):
+        return [value for item in d for value in collect_values(item, segments)]
+    if not segments:
+        return [] if d is None or d == "" else [str(leaf_value(d))]
+    if not isinstance(d, dict):
+        return []
+    values: List[str] = []
+    for i in range(len(segments), 0, -1):
+        key = ".".join(segments[:i])
+        if key in d:
+            values.extend(collect_values(d[key], segments[i:]))
+    return values
+
+
+class AlertReducer:
+    """
+    A class to collapse alerts that only differ in timestamps and ids
+    into one representative per group before building the prompt.
+    """
+
+    def __init__(
+        self,
+        processor: AlertProcessor,
+        group_keys: Optional[List[str]] = None,
+        timestamp_key: str = "@timestamp",
+        packer: Optional[PromptPacker] = None,
+    ) -> None:
+        """
+        Initialize the reducer.
+
+        :param processor: The processor formatting the representatives.
+        :param group_keys: The fields identifying duplicate alerts,
+        e.g. rule, entity fields and threat technique. They must be
+        fetched along with the keys of the processor.
+        :param timestamp_key: The field used for the time range of a group.
+        :param packer: The packer used to estimate the saved tokens.
+        """
+        self.processor = processor
+        self.group_keys = group_keys or DEFAULT_GROUP_KEYS
+        self.group_paths = [key.split(".") for key in self.group_keys]
+        self.timestamp_key = timestamp_key
+        self.packer = packer or PromptPacker()
+        self.groups: Dict[str, List[str]] = {}
+        self.tokens_saved = 0
+
+    def _group_key(self, alert: Dict[str, Any]) -> Tuple[Tuple[str, ...], ...]:
+        # All values of list fields, e.g. every threat technique, not only the first
+        return tuple(
+            tuple(sorted(set(collect_values(alert, path))))
+            for path in self.group_paths
+        )
+
+    def reduce(self, hits: Iterable[Dict[str, Any]]) -> List[str]:
+        """
+        Group the hits and format one representative per group,
+        followed by the number of alerts and their time range.
+
+        :param hits: An iterable of search hits.
+        :return: A list of formatted alert strings, in order of first appearance.
+        """
+        groups: Dict[Tuple[Tuple[str, ...], ...], Dict[str, Any]] = {}
+        for hit in hits:
+            alert = hit.get("_source", {})
+            alert["_id"] = hit.get("_id", "")
+            timestamp = str(alert.get(self.timestamp_key, ""))
+
+            key = self._group_key(alert)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = {
+                    "alert": alert,
+                    "ids": [alert["_id"]],
+                    "first_seen": timestamp,
+                    "last_seen": timestamp,
+                }
+                continue
+            group["ids"].append(alert["_id"])
+            group["first_seen"] = min(group["first_seen"], timestamp)
+            group["last_seen"] = max(group["last_seen"], timestamp)
+
+        res = []
+        self.groups = {}
+        self.tokens_saved = 0
+        for group in groups.values():
+            formatted = self.processor.plan.format(group["alert"])
+            count = len(group["ids"])
+            if count > 1:
+                summary = "\n".join(
+                    [
+                        f"alert_count,{count}",
+                        f"first_seen,{group['first_seen']}",
+                        f"last_seen,{group['last_seen']}",
+                    ]
+                )
+                self.tokens_saved += self.packer.estimate_tokens(formatted) * (
+                    count - 1
+                ) - self.packer.estimate_tokens(summary)
+                formatted = f"{formatted}\n{summary}"
+            self.groups[group["alert"]["_id"]] = group["ids"]
+            res.append(formatted)
+
+        print(
+            f"Reduced {sum(map(len, self.groups.values()))} alerts to {len(res)}, "
+            f"saving ~{self.tokens_saved} tokens"
+        )
+        return res
@@ -14,3 +14,4 @@ class EnvironmentConfig:
         self.llm_host = os.getenv("LLM_HOST", "http://localhost:11434")
         self.llm_model = os.getenv("LLM_MODEL", "")
         self.llm_token = os.getenv("LLM_TOKEN", "")
+        self.llm_cache_dir = os.getenv("LLM_CACHE_DIR", "")
@@ -1,17 +1,26 @@
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 from elasticsearch import Elasticsearch
 import requests
 
 
 class ElasticsearchClient:
-    def __init__(self, config):
+    def __init__(self, config, pool_size: int = 10):
+        """
+        Initialize the client.
+        :param config: The environment configuration.
+        :param pool_size: The number of pooled connections per node,
+        which bounds the concurrency of bulk lookups.
+        """
         self.config = config
+        self.pool_size = pool_size
         if config.es_apikey:
             self.client = Elasticsearch(
                 hosts=[config.es_host],
                 api_key=config.es_apikey,
                 verify_certs=False,
                 ca_certs=config.es_fingerprint,
+                connections_per_node=pool_size,
             )
         else:
             self.client = Elasticsearch(
@@ -19,6 +28,7 @@ class ElasticsearchClient:
                 http_auth=(config.es_user, config.es_password),
                 verify_certs=False,
                 ca_certs=config.es_fingerprint,
+                connections_per_node=pool_size,
             )
 
     def fetch_alerts(
@@ -33,6 +43,95 @@ class ElasticsearchClient:
         response = self.client.search(index=index, body=query, pretty=True)
         return response["hits"]["hits"]
 
+    def iter_alerts(
+        self,
+        query: Dict[str, Any],
+        index: str = "*",
+        page_size: int = 1000,
+        limit: Optional[int] = None,
+        keep_alive: str = "1m",
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Stream alerts from Elasticsearch page by page using a point in time
+        and search_after, so the result set is neither capped at the
+        query size nor at the max result window.
+        :param query: The query to filter alerts. Its size is ignored.
+        :param index: The index to search in. If empty, defaults to "*".
+        :param page_size: The number of hits to fetch per page.
+        :param limit: The maximum number of hits to yield. None for all.
+        :param keep_alive: How long to keep the point in time open between pages.
+        :return: A generator yielding the alerts matching the query.
+        """
+        pit = self.client.open_point_in_time(index=index or "*", keep_alive=keep_alive)
+        pit_id = pit["id"]
+
+        body = {k: v for k, v in query.items() if k not in ("size", "from")}
+        # _shard_doc is a cheap tiebreaker so search_after never skips hits
+        body["sort"] = [*query.get("sort", []), {"_shard_doc": "asc"}]
+        body["track_total_hits"] = False
+
+        yielded = 0
+        try:
+            while limit is None or yielded < limit:
+                size = page_size if limit is None else min(page_size, limit - yielded)
+                body["size"] = size
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                response = self.client.search(body=body)
+                pit_id = response.get("pit_id", pit_id)
+                hits = response["hits"]["hits"]
+                yield from hits
+
+                yielded += len(hits)
+                if len(hits) < size:
+                    break
+                body["search_after"] = hits[-1]["sort"]
+        finally:
+            self.client.close_point_in_time(id=pit_id)
+
+    def fetch_alerts_by_id(
+        self,
+        alert_ids: List[str],
+        index: str = "*",
+        chunk_size: int = 1000,
+        max_workers: int = 4,
+        keys: Optional[List[str]] = None,
+    ) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """
+        Fetch alerts by their IDs in chunks, concurrently over the pooled
+        connections. Each chunk stays below the max terms count and the
+        max result window.
+        :param alert_ids: A list of alert IDs to fetch.
+        :param index: The index to search in. If empty, defaults to "*".
+        :param chunk_size: The number of IDs per request.
+        :param max_workers: The number of concurrent requests,
+        capped at the connection pool size.
+        :param keys: The keys to format. If given, only those fields are fetched.
+        :return: The alerts in the order of `alert_ids` and the IDs not found.
+        """
+        unique_ids = list(dict.fromkeys(alert_ids))
+        chunks = [
+            unique_ids[i : i + chunk_size]
+            for i in range(0, len(unique_ids), chunk_size)
+        ]
+
+        def fetch_chunk(chunk: List[str]) -> List[Dict[str, Any]]:
+            query = AlertQuery.alerts_by_id(chunk, keys=keys)
+            response = self.client.search(index=index or "*", body=query)
+            return response["hits"]["hits"]
+
+        hits_by_id: Dict[str, Dict[str, Any]] = {}
+        workers = max(1, min(max_workers, self.pool_size, len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for hits in executor.map(fetch_chunk, chunks):
+                for hit in hits:
+                    hits_by_id.setdefault(hit["_id"], hit)
+
+        alerts = [hits_by_id[i] for i in unique_ids if i in hits_by_id]
+        missing = [i for i in unique_ids if i not in hits_by_id]
+        if missing:
+            print(f"{len(missing)} of {len(unique_ids)} alerts not found")
+        return alerts, missing
+
     def get_alert_ids_for_case(self, case_id: str) -> List[str]:
         """
         Fetch alert IDs associated with a given case ID from Kibana.
@@ -40,16 +139,11 @@ class ElasticsearchClient:
         :return: A list of alert IDs associated with the case.
         """
         url = f"{self.config.kibana_host}/api/cases/{case_id}/alerts"
-        headers = {
-            "kbn-xsrf": "true",  # Required by Kibana for API calls
-            "Content-Type": "application/json",
-            "Authorization": f"ApiKey {self.config.es_apikey}",
-        }
 
         try:
             response = requests.get(
                 url,
-                headers=headers,
+                headers=self._kibana_headers(),
                 verify=False,
                 timeout=10,
             )
@@ -60,6 +154,49 @@ class ElasticsearchClient:
             print(f"Error fetching alerts for case {case_id}: {e}")
             return []
 
+    def find_case_ids(self, status: str = "open", per_page: int = 100) -> List[str]:
+        """
+        Search Kibana for cases with the given status.
+        :param status: The case status, e.g. "open" or "in-progress".
+        :param per_page: The number of cases to request per page.
+        :return: A list of case IDs, oldest first.
+        """
+        url = f"{self.config.kibana_host}/api/cases/_find"
+        case_ids: List[str] = []
+        page = 1
+
+        try:
+            while True:
+                response = requests.get(
+                    url,
+                    headers=self._kibana_headers(),
+                    params={
+                        "status": status,
+                        "page": page,
+                        "perPage": per_page,
+                        "sortField": "createdAt",
+                        "sortOrder": "asc",
+                    },
+                    verify=False,
+                    timeout=10,
+                )
+                response.raise_for_status()
+                result = response.json()
+                case_ids.extend(case["id"] for case in result.get("cases", []))
+                if page * per_page >= result.get("total", 0):
+                    break
+                page += 1
+        except requests.RequestException as e:
+            print(f"Error searching cases with status {status}: {e}")
+        return case_ids
+
+    def _kibana_headers(self) -> Dict[str, str]:
+        return {
+            "kbn-xsrf": "true",  # Required by Kibana for API calls
+            "Content-Type": "application/json",
+            "Authorization": f"ApiKey {self.config.es_apikey}",
+        }
+
 
 class AlertQuery:
     def __init__(self):
@@ -70,11 +207,46 @@ class AlertQuery:
         pass
 
     @staticmethod
-    def new_alerts(size: int = 11, severity: str = "medium") -> Dict[str, Any]:
+    def source_includes(keys: List[str]) -> List[str]:
+        """
+        Derive the `_source` includes from the keys used to format alerts.
+        Fields under "kibana.alert.rule.threat" fetch the whole threat subtree,
+        metadata fields like `_id` are returned with every hit anyway.
+        :param keys: The keys to format, e.g. from data/keys.txt.
+        :return: The deduplicated list of source fields to include.
+        """
+        field_threat = "kibana.alert.rule.threat"
+        includes = []
+        for key in keys:
+            if not key or key.startswith("_"):
+                continue
+            if key.startswith(field_threat):
+                key = field_threat
+            if key not in includes:
+                includes.append(key)
+        return includes
+
+    @staticmethod
+    def project(query: Dict[str, Any], keys: Optional[List[str]]) -> Dict[str, Any]:
+        """
+        Restrict the `_source` of a query to the fields needed for the keys.
+        :param query: The query to project.
+        :param keys: The keys to format. If None, the full source is fetched.
+        :return: The query with `_source` includes set.
+        """
+        if keys is not None:
+            query["_source"] = {"includes": AlertQuery.source_includes(keys)}
+        return query
+
+    @staticmethod
+    def new_alerts(
+        size: int = 11, severity: str = "medium", keys: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
         """
         Build a query to fetch new alerts based on severity and size.
         :param size: The number of alerts to fetch.
         :param severity: The severity level of the alerts to fetch.
+        :param keys: The keys to format. If given, only those fields are fetched.
         :return: The query to fetch new alerts.
         """
         query = {
@@ -89,17 +261,18 @@ class AlertQuery:
                 }
             },
         }
-        return query
+        return AlertQuery.project(query, keys)
 
     @staticmethod
-    def alerts_by_id(alert_ids: List[str]) -> Dict[str, Any]:
+    def alerts_by_id(
+        alert_ids: List[str], keys: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
         """
         Build a query to fetch alerts by their IDs.
         :param alert_ids: A list of alert IDs to fetch.
+        :param keys: The keys to format. If given, only those fields are fetched.
         :return: The query to fetch alerts by ID.
         """
-        for alert_id in alert_ids:
-            print(alert_id)
         query = {
             "size": len(alert_ids),
             "query": {
@@ -109,4 +282,4 @@ class AlertQuery:
             },
             "sort": [{"@timestamp": {"order": "desc"}}],
         }
-        return query
+        return AlertQuery.project(query, keys)
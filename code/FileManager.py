@@ -1,5 +1,39 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, IO, Iterable, Iterator, Optional
+import gzip
 import json
+import queue
+import threading
+
+try:
+    # Optional faster JSON backend
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_line(record: Any) -> bytes:
+    """
+    Serialize a record to a single compact JSON line.
+    """
+    if orjson is not None:
+        return orjson.dumps(record) + b"\n"
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def loads_line(line: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def open_binary(filepath: str, mode: str) -> IO[bytes]:
+    """
+    Open a file in binary mode, gzip compressed if it ends with .gz.
+    """
+    if filepath.endswith(".gz"):
+        # Fast compression level, artifacts are written on the fly
+        return gzip.open(filepath, mode, compresslevel=1)
+    return open(filepath, mode)
 
 
 class FileManager:
@@ -17,3 +51,99 @@ class FileManager:
     def write_text(filepath: str, content: str) -> None:
         with open(filepath, "w", encoding="utf-8") as f:
             print(content, file=f)
+
+    @staticmethod
+    def write_ndjson(filepath: str, records: Iterable[Any]) -> int:
+        """
+        Write records as newline delimited JSON, one record at a time.
+        :param filepath: The file to write, gzip compressed if it ends with .gz.
+        :param records: An iterable of JSON serializable records.
+        :return: The number of records written.
+        """
+        count = 0
+        with open_binary(filepath, "wb") as f:
+            for record in records:
+                f.write(dumps_line(record))
+                count += 1
+        return count
+
+    @staticmethod
+    def read_ndjson(filepath: str) -> Iterator[Any]:
+        """
+        Read newline delimited JSON one record at a time.
+        :param filepath: The file to read, gzip compressed if it ends with .gz.
+        :return: A generator of records.
+        """
+        with open_binary(filepath, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield loads_line(line)
+
+
+class NdjsonWriter:
+    """
+    Write newline delimited JSON from a background thread.
+
+    Records are serialized when submitted, so later changes to them do not
+    race with the writer; compression and disk I/O happen off the caller's path.
+    """
+
+    def __init__(self, filepath: str, max_pending: int = 1024) -> None:
+        """
+        Open the file and start the writer thread.
+        :param filepath: The file to write, gzip compressed if it ends with .gz.
+        :param max_pending: The number of lines buffered before `write` blocks.
+        """
+        self.filepath = filepath
+        self.count = 0
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue(max_pending)
+        self._file = open_binary(filepath, "wb")
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, record: Any) -> None:
+        self._queue.put(dumps_line(record))
+        self.count += 1
+
+    def write_many(self, records: Iterable[Any]) -> None:
+        for record in records:
+            self.write(record)
+
+    def close(self) -> None:
+        """
+        Flush all pending records and close the file.
+        Raises the first error of the writer thread, if any.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._file.close()
+        except Exception as e:
+            self._error = self._error or e
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        while True:
+            lines: List[bytes] = [self._queue.get()]
+            # Write everything pending in one go
+            while lines[-1] is not None and not self._queue.empty():
+                lines.append(self._queue.get_nowait())
+            done = lines[-1] is None
+            if self._error is None:
+                try:
+                    self._file.write(
+                        b"".join(line for line in lines if line is not None)
+                    )
+                except Exception as e:
+                    # Keep draining so close() never waits on a dead writer
+                    self._error = e
+            if done:
+                return
+
+    def __enter__(self) -> "NdjsonWriter":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+# Payload fields that change the transport but not the completion
+TRANSPORT_KEYS = ("stream", "stream_options")
+
+
+class LLMCache:
+    """
+    A content-addressed on-disk cache of LLM completions.
+
+    Completions are stored as the list of streamed deltas, so a hit replays
+    the same chunks when streaming and the same text when joined.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = "data/llm_cache",
+        max_bytes: int = 512 * 1024 * 1024,
+        ttl: Optional[float] = 7 * 24 * 3600,
+    ) -> None:
+        """
+        Initialize the cache.
+        :param cache_dir: The directory to store the completions in.
+        :param max_bytes: The size above which the least recently used
+        completions are evicted.
+        :param ttl: Seconds after which a completion expires. None to keep forever.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._entries())
+
+    @staticmethod
+    def key(payload: Dict[str, Any]) -> str:
+        """
+        Hash the model, messages and sampling parameters of a payload.
+        :param payload: The chat completion request.
+        :return: The hex digest identifying the completion.
+        """
+        canonical = {k: v for k, v in payload.items() if k not in TRANSPORT_KEYS}
+        encoded = json.dumps(
+            canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        )
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """
+        Look up a completion.
+        :param key: The key from `key`.
+        :return: The cached deltas, or None on a miss.
+        """
+        path = self._path(key)
+        with self._lock:
+            try:
+                stat = os.stat(path)
+                if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+                    self._remove(path, stat.st_size)
+                    raise FileNotFoundError(path)
+                with open(path, "r", encoding="utf-8") as f:
+                    deltas = json.load(f)["deltas"]
+            except (OSError, ValueError, KeyError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Mark as recently used, the ttl counts from the last store
+            os.utime(path, (time.time(), stat.st_mtime))
+        return deltas
+
+    def put(self, key: str, deltas: List[str]) -> None:
+        """
+        Store a completion and evict old ones above the size limit.
+        Empty completions, e.g. of truncated or failed generations, are skipped.
+        :param key: The key from `key`.
+        :param deltas: The streamed content deltas of the completion.
+        """
+        if not "".join(deltas).strip():
+            return
+        path = self._path(key)
+        # Unique across threads and processes sharing the cache directory
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex}"
+        tmp_path += ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "deltas": deltas}, f)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            if os.path.exists(path):
+                self._size -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        :return: Hit and miss counters and the resident size.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes": self._size,
+        }
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _entries(self) -> List[str]:
+        return [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(".json")
+        ]
+
+    def _remove(self, path: str, size: int) -> None:
+        os.remove(path)
+        self._size -= size
+        self.evictions += 1
+
+    def _evict(self) -> None:
+        # Least recently used first, by access time
+        now = time.time()
+        entries = []
+        for path in self._entries():
+            stat = os.stat(path)
+            if self.ttl is not None and now - stat.st_mtime > self.ttl:
+                self._remove(path, stat.st_size)
+            else:
+                entries.append((stat.st_atime, stat.st_size, path))
+        for _, size, path in sorted(entries):
+            if self._size <= self.max_bytes:
+                break
+            self._remove(path, size)
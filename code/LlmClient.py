@@ -1,14 +1,59 @@
 import requests
 import json
-from typing import Dict, Any
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
+from typing import Deque, Dict, Any, Callable, Iterator, List, Optional, Tuple
+
+from LlmCache import LLMCache
+
+# Statuses of requests shed by the proxy's admission control or the backend
+RETRY_STATUS = (429, 503)
+
+
+@dataclass
+class LLMCallStats:
+    """
+    Timings of a single streamed LLM call.
+    """
+
+    time_to_first_token: Optional[float] = None
+    total_latency: float = 0.0
+    tokens: int = 0
+    tokens_per_second: float = 0.0
+    cached: bool = False
+    # The stream ended with [DONE] or a finish_reason, not a dropped connection
+    complete: bool = False
 
 
 class LLMClient:
-    def __init__(self, llm_host: str, llm_token: str) -> None:
+    def __init__(
+        self,
+        llm_host: str,
+        llm_token: str,
+        pool_size: int = 10,
+        timeout: int = 100,
+        cache: Optional[LLMCache] = None,
+        priority: Optional[str] = "batch",
+        stats_history: int = 1000,
+        max_retries: int = 5,
+        max_retry_wait: float = 60.0,
+    ) -> None:
         """
         Initialize the LLM client with the host and token.
         :param llm_host: The host URL for the LLM service.
         :param llm_token: The token for authenticating with the LLM service.
+        :param pool_size: The number of pooled connections to the LLM service.
+        :param timeout: The connect and read timeout in seconds.
+        :param cache: Optional cache replaying completions of identical payloads.
+        :param priority: Sent as X-Priority, queues triage behind interactive
+            clients at the proxy's admission control.
+        :param stats_history: The number of recent call stats kept in `stats`.
+        :param max_retries: Retries of a request shed with 429 or 503.
+        :param max_retry_wait: Upper bound in seconds of a single wait, also
+            when the server's Retry-After asks for longer.
         """
 
         self.url = f"{llm_host}/v1beta/openai/chat/completions"
@@ -16,37 +61,177 @@ class LLMClient:
             "Authorization": f"Bearer {llm_token}",
             "Content-Type": "application/json",
         }
+        if priority:
+            self.headers["X-Priority"] = priority
+        self.timeout = timeout
+        self.cache = cache
+        self.max_retries = max_retries
+        self.max_retry_wait = max_retry_wait
+
+        # Keep connections alive across prompts
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Stats of the calls of all threads, last_stats of the calling thread
+        self.stats: Deque[LLMCallStats] = deque(maxlen=stats_history)
+        self._local = threading.local()
 
-    def send_prompt(self, payload: Dict[str, Any]) -> str:
+    @property
+    def last_stats(self) -> Optional[LLMCallStats]:
+        """
+        The stats of the last call finished by the current thread.
+        """
+        return getattr(self._local, "stats", None)
+
+    def stream_prompt(
+        self,
+        payload: Dict[str, Any],
+        on_delta: Optional[Callable[[str], None]] = None,
+        stats: Optional[LLMCallStats] = None,
+    ) -> Iterator[str]:
+        """
+        Send the prompt and yield the content deltas as they arrive.
+        The timings are recorded in `stats` once the stream ends.
+        :param payload: The chat completion request.
+        :param on_delta: Optional callback invoked with every delta.
+        :param stats: The stats to record the timings in, a new one if None.
+        :return: A generator of content deltas.
+        """
         payload["stream"] = True  # Enable streaming
-        result = ""
-
-        with requests.post(
-            self.url,
-            headers=self.headers,
-            json=payload,
-            verify=False,
-            timeout=100,
-            stream=True,
-        ) as response:
+        stats = stats if stats is not None else LLMCallStats()
+        start = time.perf_counter()
+
+        key = self.cache.key(payload) if self.cache else None
+        cached = self.cache.get(key) if key else None
+        stats.cached = cached is not None
+        stats.complete = stats.cached
+        deltas: List[str] = []
+        delta_count = 0
+
+        source = cached if stats.cached else self._stream(payload, stats)
+        for content_piece in source:
+            if stats.time_to_first_token is None:
+                stats.time_to_first_token = time.perf_counter() - start
+            delta_count += 1
+            if key:
+                deltas.append(content_piece)
+            if on_delta:
+                on_delta(content_piece)
+            yield content_piece
+
+        if key and not stats.cached:
+            if stats.complete:
+                self.cache.put(key, deltas)
+            else:
+                print("LLM stream ended early, not caching the completion")
+
+        stats.total_latency = time.perf_counter() - start
+        if not stats.tokens:
+            # Without usage, count every delta as one token
+            stats.tokens = delta_count
+        if stats.time_to_first_token is not None:
+            generation_time = stats.total_latency - stats.time_to_first_token
+            if generation_time > 0:
+                stats.tokens_per_second = stats.tokens / generation_time
+        self._local.stats = stats
+        self.stats.append(stats)
+        print(
+            f"LLM time to first token: {stats.time_to_first_token or 0:.2f}s, "
+            f"{stats.tokens_per_second:.1f} tokens/s, total {stats.total_latency:.2f}s"
+            + (" (cached)" if stats.cached else "")
+        )
+
+    def _stream(self, payload: Dict[str, Any], stats: LLMCallStats) -> Iterator[str]:
+        """
+        Send the payload upstream and yield the content deltas.
+        :param payload: The chat completion request with streaming enabled.
+        :param stats: The stats to record reported token usage and
+        whether the stream completed in.
+        :return: A generator of content deltas.
+        """
+        for attempt in range(self.max_retries + 1):
+            response = self.session.post(
+                self.url,
+                json=payload,
+                timeout=self.timeout,
+                stream=True,
+            )
             print(f"LLM response status: {response.status_code}")
+            if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                break
+            wait = self._retry_wait(response, attempt)
+            response.close()
+            print(f"LLM overloaded, retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+        with response:
             response.raise_for_status()
 
             for line in response.iter_lines(decode_unicode=True):
                 if line:
                     if line.strip() == "data: [DONE]":
+                        stats.complete = True
                         break
                     try:
                         line_data = line.strip().removeprefix("data: ")
                         delta = json.loads(line_data)
-                        content_piece = (
-                            delta["choices"][0].get("delta", {}).get("content")
-                        )
+                        usage = delta.get("usage") or {}
+                        if not delta.get("choices") and usage:
+                            # Final usage chunk without choices
+                            stats.tokens = usage.get("completion_tokens", stats.tokens)
+                            continue
+                        choice = delta["choices"][0]
+                        if choice.get("finish_reason"):
+                            stats.complete = True
+                        content_piece = choice.get("delta", {}).get("content")
                         if content_piece:
-                            result += content_piece
+                            yield content_piece
                     except json.JSONDecodeError as e:
                         print(f"JSON decode error: {e} - line: {line}")
                     except (KeyError, IndexError) as e:
                         print(f"Unexpected format: {e} - delta: {delta}")
 
-        return result
+    def _retry_wait(self, response: requests.Response, attempt: int) -> float:
+        """
+        Seconds to wait before retrying a shed request.
+        :param response: The 429 or 503 response.
+        :param attempt: The number of the failed attempt, from 0.
+        :return: Retry-After if given in seconds, else an exponential backoff.
+        """
+        try:
+            wait = float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            wait = 2.0**attempt
+        return min(max(wait, 0.0), self.max_retry_wait)
+
+    def send_prompt(
+        self,
+        payload: Dict[str, Any],
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """
+        Send the prompt and return the complete answer.
+        :param payload: The chat completion request.
+        :param on_delta: Optional callback invoked with every delta.
+        :return: The content of the completion.
+        """
+        return "".join(self.stream_prompt(payload, on_delta=on_delta))
+
+    def prompt(
+        self,
+        payload: Dict[str, Any],
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> Tuple[str, LLMCallStats]:
+        """
+        Send the prompt and return the complete answer with its timings.
+        :param payload: The chat completion request.
+        :param on_delta: Optional callback invoked with every delta.
+        :return: The content of the completion and the stats of the call.
+        """
+        stats = LLMCallStats()
+        content = "".join(self.stream_prompt(payload, on_delta=on_delta, stats=stats))
+        return content, stats
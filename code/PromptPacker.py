@@ -0,0 +1,194 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from AlertProcessor import AlertProcessor
+from LlmClient import LLMClient
+
+
+class PromptPacker:
+    """
+    A class to split formatted alerts into prompts that fit a token budget.
+    """
+
+    def __init__(
+        self,
+        budget_tokens: int = 71000,
+        reserve_tokens: int = 8000,
+        chars_per_token: float = 4.0,
+    ) -> None:
+        """
+        Initialize the packer.
+
+        :param budget_tokens: The context size of the model, see ctxLlama/Modelfile.
+        :param reserve_tokens: Tokens kept free for the answer.
+        :param chars_per_token: Average characters per token used for estimates.
+        """
+        self.budget_tokens = budget_tokens
+        self.reserve_tokens = reserve_tokens
+        self.chars_per_token = chars_per_token
+
+    def estimate_tokens(self, text: str) -> int:
+        """
+        Estimate the number of tokens of a text.
+
+        :param text: The text to estimate.
+        :return: The estimated number of tokens, at least 1.
+        """
+        return int(len(text) / self.chars_per_token) + 1
+
+    def pack(self, base_prompt: str, alerts: List[str]) -> List[List[str]]:
+        """
+        Split the alerts into batches, each fitting the budget together
+        with the base prompt. Alerts keep their order, an alert larger
+        than the budget gets a batch of its own.
+
+        :param base_prompt: The base prompt prepended to every batch.
+        :param alerts: A list of formatted alert strings.
+        :return: A list of batches of formatted alert strings.
+        """
+        available = (
+            self.budget_tokens - self.reserve_tokens - self.estimate_tokens(base_prompt)
+        )
+        batches: List[List[str]] = []
+        batch: List[str] = []
+        used = 0
+        for alert in alerts:
+            tokens = self.estimate_tokens(alert)
+            if batch and used + tokens > available:
+                batches.append(batch)
+                batch, used = [], 0
+            if tokens > available:
+                print(f"Alert of ~{tokens} tokens exceeds the prompt budget")
+            batch.append(alert)
+            used += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+
+class MapReduceTriage:
+    """
+    A class to triage alerts in batches that fit the context of the model
+    and merge the partial verdicts.
+    """
+
+    def __init__(
+        self,
+        llm_client: LLMClient,
+        packer: PromptPacker,
+        model: str,
+        reduce_prompt: Optional[str] = None,
+        max_workers: int = 2,
+        slots: Optional[threading.Semaphore] = None,
+    ) -> None:
+        """
+        Initialize the map-reduce triage.
+
+        :param llm_client: The client to send the prompts to.
+        :param packer: The packer splitting the alerts into batches.
+        :param model: The model name for the payloads.
+        :param reduce_prompt: The prompt to merge partial verdicts with the LLM.
+        If None, the JSON arrays of the partial verdicts are concatenated.
+        :param max_workers: The number of batches sent concurrently.
+        :param slots: Optional semaphore acquired for every LLM call, e.g. the
+        LLM stage limit shared by all cases of a pipeline.
+        """
+        self.llm_client = llm_client
+        self.packer = packer
+        self.model = model
+        self.reduce_prompt = reduce_prompt
+        self.max_workers = max_workers
+        self.slots = slots
+
+    def build_payloads(
+        self, base_prompt: str, alerts: List[str]
+    ) -> List[Dict[str, Any]]:
+        """
+        Build one chat completion payload per batch of alerts.
+
+        :param base_prompt: The base prompt string.
+        :param alerts: A list of formatted alert strings.
+        :return: A list of payloads.
+        """
+        return [
+            self._payload(AlertProcessor.format_prompt(base_prompt, batch))
+            for batch in self.packer.pack(base_prompt, alerts)
+        ]
+
+    def run(self, payloads: List[Dict[str, Any]]) -> str:
+        """
+        Send the payloads concurrently and merge the partial verdicts.
+
+        :param payloads: The payloads from `build_payloads`.
+        :return: The merged content.
+        """
+        partials = self._map(payloads)
+        if len(partials) == 1:
+            return partials[0]
+        if self.reduce_prompt is None:
+            return self._merge_arrays(partials)
+        return self._reduce(partials)
+
+    def _payload(self, prompt: str) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": True,
+        }
+
+    def _send(self, payload: Dict[str, Any]) -> str:
+        if self.slots is None:
+            return self.llm_client.send_prompt(payload)
+        with self.slots:
+            return self.llm_client.send_prompt(payload)
+
+    def _map(self, payloads: List[Dict[str, Any]]) -> List[str]:
+        if len(payloads) == 1:
+            return [self._send(payloads[0])]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self._send, payloads))
+
+    def _reduce(self, partials: List[str]) -> str:
+        # Reduce in rounds until a single verdict is left
+        while len(partials) > 1:
+            batches = self.packer.pack(self.reduce_prompt, partials)
+            if len(batches) == len(partials):
+                print("Partial verdicts too large to reduce, concatenating")
+                return "\n\n".join(partials)
+            partials = self._map(
+                [
+                    self._payload(AlertProcessor.format_prompt(self.reduce_prompt, b))
+                    for b in batches
+                ]
+            )
+        return partials[0]
+
+    @staticmethod
+    def _find_array(text: str) -> Optional[List[Any]]:
+        # The longest JSON array in the text, prose may contain other brackets
+        decoder = json.JSONDecoder()
+        best, best_length = None, -1
+        start = text.find("[")
+        while start != -1:
+            try:
+                value, end = decoder.raw_decode(text, start)
+            except ValueError:
+                start = text.find("[", start + 1)
+                continue
+            if isinstance(value, list) and end - start > best_length:
+                best, best_length = value, end - start
+            start = text.find("[", end)
+        return best
+
+    @staticmethod
+    def _merge_arrays(partials: List[str]) -> str:
+        merged: List[Any] = []
+        for partial in partials:
+            verdicts = MapReduceTriage._find_array(partial)
+            if verdicts is None:
+                print("Could not merge partial verdict: no JSON array found")
+                return "\n\n".join(partials)
+            merged.extend(verdicts)
+        return json.dumps(merged, indent=2)
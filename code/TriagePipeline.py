@@ -0,0 +1,151 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional
+
+from AlertProcessor import AlertProcessor
+from AlertReducer import DEFAULT_GROUP_KEYS, AlertReducer
+from EsClient import ElasticsearchClient
+from FileManager import FileManager, NdjsonWriter
+from LlmClient import LLMClient
+from PromptPacker import MapReduceTriage, PromptPacker
+
+
+class TriagePipeline:
+    """
+    Triage many Kibana cases with the stages of run.py overlapping
+    across cases. Each stage has its own concurrency limit, so the LLM
+    keeps working on one case while alerts for the next are fetched.
+    """
+
+    def __init__(
+        self,
+        es: ElasticsearchClient,
+        llm_client: LLMClient,
+        processor: AlertProcessor,
+        base_prompt: str,
+        model: str,
+        index: str = ".internal.alerts-sec*",
+        out_dir: str = "data/cases",
+        kibana_workers: int = 4,
+        es_workers: int = 4,
+        format_workers: int = 2,
+        llm_workers: int = 2,
+        max_in_flight: Optional[int] = None,
+        packer: Optional[PromptPacker] = None,
+        reduce_prompt: Optional[str] = None,
+        group_keys: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Initialize the pipeline.
+        :param es: The Elasticsearch client for case and alert lookups.
+        :param llm_client: The client to send the prompts to.
+        :param processor: The processor holding the compiled keys.
+        :param base_prompt: The prompt prepended to the alerts.
+        :param model: The model name for the payload.
+        :param index: The alerts index pattern.
+        :param out_dir: Directory for the per case results.
+        :param kibana_workers: Concurrent Kibana case lookups.
+        :param es_workers: Concurrent Elasticsearch alert fetches.
+        :param format_workers: Concurrent formatting jobs.
+        :param llm_workers: Concurrent LLM calls.
+        :param max_in_flight: Cases processed at the same time.
+        Defaults to the sum of all stage limits.
+        :param packer: Splits the alerts of a case into prompts fitting the
+        model context. Defaults to the 71000 token context of ctxLlama.
+        :param reduce_prompt: The prompt to merge partial verdicts with the LLM.
+        :param group_keys: The fields identifying duplicate alerts within a case.
+        Defaults to rule, host, user and threat technique.
+        """
+        self.es = es
+        self.llm_client = llm_client
+        self.processor = processor
+        self.base_prompt = base_prompt
+        self.model = model
+        self.index = index
+        self.out_dir = out_dir
+        self.kibana_slots = threading.BoundedSemaphore(kibana_workers)
+        self.es_slots = threading.BoundedSemaphore(es_workers)
+        self.format_slots = threading.BoundedSemaphore(format_workers)
+        self.llm_slots = threading.BoundedSemaphore(llm_workers)
+        self.group_keys = group_keys or DEFAULT_GROUP_KEYS
+        self.triage = MapReduceTriage(
+            llm_client,
+            packer or PromptPacker(),
+            model,
+            reduce_prompt=reduce_prompt,
+            slots=self.llm_slots,
+        )
+        self.max_in_flight = max_in_flight or (
+            kibana_workers + es_workers + format_workers + llm_workers
+        )
+
+    def run(self, case_ids: Iterable[str]) -> Dict[str, str]:
+        """
+        Triage all cases and write the results per case.
+        :param case_ids: The IDs of the cases to triage.
+        :return: The status of each case, "ok", "empty" or the error.
+        """
+        case_ids = list(dict.fromkeys(case_ids))
+        results: Dict[str, str] = {}
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            futures = {
+                executor.submit(self.triage_case, case_id): case_id
+                for case_id in case_ids
+            }
+            for future in as_completed(futures):
+                case_id = futures[future]
+                try:
+                    results[case_id] = future.result()
+                except Exception as e:
+                    results[case_id] = f"error: {e}"
+                print(f"Case {case_id}: {results[case_id]}")
+        return results
+
+    def triage_case(self, case_id: str) -> str:
+        """
+        Run all stages for a single case.
+        :param case_id: The ID of the case to triage.
+        :return: "ok" if the case was triaged, "empty" if it has no alerts.
+        """
+        with self.kibana_slots:
+            alert_ids = self.es.get_alert_ids_for_case(case_id)
+        if not alert_ids:
+            return "empty"
+
+        with self.es_slots:
+            alerts, _ = self.es.fetch_alerts_by_id(
+                alert_ids, self.index, keys=self.processor.keys + self.group_keys
+            )
+        if not alerts:
+            return "empty"
+
+        case_dir = os.path.join(self.out_dir, case_id)
+        os.makedirs(case_dir, exist_ok=True)
+        # Debug artifacts are written in the background, off the critical path
+        alert_log = NdjsonWriter(os.path.join(case_dir, "alerts.ndjson.gz"))
+        payload_log = NdjsonWriter(os.path.join(case_dir, "payload.ndjson"))
+        try:
+            alert_log.write_many(alerts)
+            with self.format_slots:
+                # A reducer per case, as it keeps the groups of the last reduce
+                reducer = AlertReducer(
+                    self.processor, self.group_keys, packer=self.triage.packer
+                )
+                processed_alerts: List[str] = reducer.reduce(alerts)
+                payloads = self.triage.build_payloads(
+                    self.base_prompt, processed_alerts
+                )
+            payload_log.write_many(payloads)
+
+            # Every batch takes its own LLM slot
+            content = self.triage.run(payloads)
+            FileManager.write_text(os.path.join(case_dir, "content.json"), content)
+        finally:
+            # A failed debug artifact must not throw away the verdict
+            for log in (alert_log, payload_log):
+                try:
+                    log.close()
+                except Exception as e:
+                    print(f"Could not write {log.filepath}: {e}")
+        return "ok"
@@ -0,0 +1,60 @@
+import json
+
+from LlmCache import LLMCache
+from LlmClient import LLMClient
+
+
+class FakeResponse:
+    def __init__(self, lines, status_code=200):
+        self.lines = lines
+        self.status_code = status_code
+        self.headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self.lines)
+
+
+def chunk(content, finish_reason=None):
+    choice = {"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}
+    return "data: " + json.dumps({"choices": [choice]})
+
+
+def client(tmp_path, lines):
+    llm_client = LLMClient("http://llm", "token", cache=LLMCache(str(tmp_path)))
+    llm_client.session.post = lambda *args, **kwargs: FakeResponse(lines)
+    return llm_client
+
+
+def payload():
+    return {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+
+
+def test_truncated_stream_is_not_cached(tmp_path):
+    # The connection drops without [DONE] or a finish_reason
+    llm_client = client(tmp_path, [chunk("par"), chunk("tial")])
+    content, stats = llm_client.prompt(payload())
+    assert content == "partial"
+    assert not stats.complete
+    assert llm_client.cache.get(LLMCache.key(payload())) is None
+
+
+def test_complete_stream_is_cached(tmp_path):
+    llm_client = client(tmp_path, [chunk("do"), chunk("ne", "stop"), "data: [DONE]"])
+    content, stats = llm_client.prompt(payload())
+    assert content == "done" and stats.complete
+    assert llm_client.cache.get(LLMCache.key(payload())) == ["do", "ne"]
+
+    content, stats = llm_client.prompt(payload())
+    assert content == "done" and stats.cached
@@ -0,0 +1,252 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, NamedTuple
+
+NS_PER_SECOND = 10 ** 9
+
+
+class IntervalHistograms(NamedTuple):
+    """Interval histograms of all pairs, in CSR layout.
+
+    The histogram of pair pairs[i] holds the distinct intervals
+    intervals[offsets[i]:offsets[i + 1]] in ascending order, with their
+    counts at the same positions.
+    """
+    pairs: np.ndarray       # pair code of each histogram, ascending
+    offsets: np.ndarray     # len(pairs) + 1 bounds into intervals/counts
+    intervals: np.ndarray   # distinct intervals per pair
+    counts: np.ndarray      # occurrences of each interval
+    totals: np.ndarray      # intervals per pair
+    first_rows: np.ndarray  # input row of the earliest event of each pair
+
+    def histogram(self, i: int) -> Dict[int, int]:
+        """Interval counts of the i-th pair as a dict."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return dict(zip(self.intervals[start:end].tolist(),
+                        self.counts[start:end].tolist()))
+
+
+def epoch_nanoseconds(timestamps: pd.Series) -> np.ndarray:
+    """Parse timestamps to int64 nanoseconds since the epoch.
+
+    Numbers are taken as epoch millis, the default of Elasticsearch dates,
+    strings as ISO 8601 dates.
+    """
+    if pd.api.types.is_numeric_dtype(timestamps):
+        parsed = pd.to_datetime(timestamps, unit='ms', utc=True)
+    else:
+        parsed = pd.to_datetime(timestamps, utc=True)
+    naive = parsed.dt.tz_localize(None).astype('datetime64[ns]')
+    return naive.to_numpy().view(np.int64)
+
+
+def pair_ids(senders: pd.Series, receivers: pd.Series) -> pd.Series:
+    """hash(sender + receiver) of every email.
+
+    For categorical columns only the distinct pairs are concatenated
+    and hashed.
+    """
+    if isinstance(senders.dtype, pd.CategoricalDtype) and isinstance(receivers.dtype, pd.CategoricalDtype):
+        n = len(receivers.cat.categories)
+        combined = senders.cat.codes.to_numpy(np.int64) * n + receivers.cat.codes.to_numpy(np.int64)
+        unique, inverse = np.unique(combined, return_inverse=True)
+        hashes = np.array([hash(senders.cat.categories[u // n] + receivers.cat.categories[u % n])
+                           for u in unique.tolist()], dtype=np.int64)
+        return pd.Series(hashes[inverse], index=senders.index)
+    return (senders + receivers).apply(hash)
+
+
+def interval_histograms(pair_codes, timestamps, min_interval=0, resolution=1,
+                        keep_first=False) -> IntervalHistograms:
+    """Histograms of the intervals between consecutive events of every pair.
+
+    One global sort by (pair, timestamp) and a segmented diff replace
+    sorting and diffing each pair on its own.
+
+    Args:
+        pair_codes: Integer code of the pair of each event.
+        timestamps: Integer timestamp of each event.
+        min_interval (int): Intervals below are dropped.
+        resolution (int): Timestamp units per interval unit, intervals
+            are truncated, e.g. NS_PER_SECOND for nanosecond timestamps.
+        keep_first (bool): Count the first event of each pair as an
+            interval of 0, like a diff filled with 0.
+
+    Returns:
+        IntervalHistograms: Pairs without any interval are left out.
+    """
+    pair_codes = np.asarray(pair_codes, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    order = np.lexsort((timestamps, pair_codes))
+    pairs = pair_codes[order]
+    stamps = timestamps[order]
+
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = pairs[1:] != pairs[:-1]
+    deltas = np.zeros(len(pairs), dtype=np.int64)
+    deltas[1:] = (stamps[1:] - stamps[:-1]) // resolution
+    deltas[first] = 0
+    first_pairs, first_rows = pairs[first], order[first]
+
+    keep = deltas >= min_interval
+    if not keep_first:
+        keep &= ~first
+    hist = delta_histograms(pairs[keep], deltas[keep])
+    return hist._replace(first_rows=first_rows[np.searchsorted(first_pairs, hist.pairs)])
+
+
+def delta_histograms(pair_codes, deltas) -> IntervalHistograms:
+    """Histograms of already computed intervals, grouped by pair.
+
+    Args:
+        pair_codes: Integer code of the pair of each interval.
+        deltas: The intervals.
+
+    Returns:
+        IntervalHistograms: first_rows holds the input row of the
+            first interval of each pair.
+    """
+    pair_codes = np.asarray(pair_codes, dtype=np.int64)
+    deltas = np.asarray(deltas, dtype=np.int64)
+
+    # Group equal intervals, pairs stay in ascending order
+    order = np.lexsort((deltas, pair_codes))
+    pairs, deltas = pair_codes[order], deltas[order]
+    starts = np.ones(len(pairs), dtype=bool)
+    starts[1:] = (pairs[1:] != pairs[:-1]) | (deltas[1:] != deltas[:-1])
+    starts = np.flatnonzero(starts)
+    counts = np.diff(np.append(starts, len(pairs)))
+    hist_pairs, intervals = pairs[starts], deltas[starts]
+
+    pair_starts = np.ones(len(hist_pairs), dtype=bool)
+    pair_starts[1:] = hist_pairs[1:] != hist_pairs[:-1]
+    pair_starts = np.flatnonzero(pair_starts)
+    offsets = np.append(pair_starts, len(hist_pairs))
+    if len(counts):
+        totals = np.add.reduceat(counts, pair_starts)
+    else:
+        totals = np.zeros(0, dtype=np.int64)
+    unique_pairs, first_rows = np.unique(pair_codes, return_index=True)
+
+    return IntervalHistograms(
+        pairs=unique_pairs,
+        offsets=offsets,
+        intervals=intervals,
+        counts=counts,
+        totals=totals,
+        first_rows=first_rows,
+    )
+
+
+def _cumulative_counts(hist, segment, x):
+    """Counts of the intervals <= x in the histograms of the given segments.
+
+    All queries are answered by one searchsorted over the intervals of all
+    pairs, shifted so every pair gets its own disjoint value range.
+    """
+    lo, hi = hist.intervals.min(), hist.intervals.max()
+    span = hi - lo + 1
+    shifted = hist.intervals - lo + np.repeat(np.arange(len(hist.pairs)) * span,
+                                              np.diff(hist.offsets))
+    query = segment * span + np.clip(x - lo, -1, hi - lo)
+    cumulative = np.concatenate(([0], np.cumsum(hist.counts)))
+    position = np.searchsorted(shifted, query, side='right')
+    return cumulative[position] - cumulative[hist.offsets[segment]]
+
+
+def _first_max(segment, score, n_segments):
+    """Index of the first maximum score of each segment, -1 if it has none.
+
+    Candidates are expected in ascending order of their window start
+    within each segment.
+    """
+    order = np.lexsort((np.arange(len(score)), -score, segment))
+    heads = np.ones(len(order), dtype=bool)
+    heads[1:] = segment[order][1:] != segment[order][:-1]
+    best = np.full(n_segments, -1, dtype=np.int64)
+    best[segment[order][heads]] = order[heads]
+    return best
+
+
+def best_windows(hist: IntervalHistograms, window: int, method: str = 'span'):
+    """Best interval window and its share of all intervals, for every pair.
+
+    Windows are scored from the cumulative histograms of all pairs at once,
+    instead of re-summing the histogram for every window start. As in the
+    detectors, the first window with the highest count wins.
+
+    Args:
+        hist (IntervalHistograms): The interval histograms.
+        window (int): Width of the window.
+        method (str): Which windows are scored:
+            'span': windows [s, s + window] for every start s from the
+                smallest up to, not including, the largest interval,
+                the detected interval is (2s + window) // 2 (flare_full).
+            'keys': windows of `window` consecutive distinct intervals,
+                the detected interval is the middle one (flare.py).
+            'peak': windows [s, s + window) with s from
+                peak - window to peak, where peak is the smallest most
+                frequent interval, the detected interval is
+                s + window // 2 (flare_gpt).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Detected interval and percent
+            of the intervals in the window, aligned with hist.pairs.
+    """
+    n_pairs = len(hist.pairs)
+    best_interval = np.zeros(n_pairs, dtype=np.int64)
+    best_percent = np.zeros(n_pairs, dtype=np.float64)
+    if n_pairs == 0:
+        return best_interval, best_percent
+    sizes = np.diff(hist.offsets)
+    segment_of = np.repeat(np.arange(n_pairs), sizes)
+    first_interval = hist.intervals[hist.offsets[:-1]]
+    last_interval = hist.intervals[hist.offsets[1:] - 1]
+
+    if method == 'keys':
+        if window <= 0:
+            return best_interval, best_percent
+        # Windows start at every distinct interval with window - 1 more after it
+        local = np.arange(len(hist.intervals)) - hist.offsets[segment_of]
+        valid = local + window <= sizes[segment_of]
+        start = np.flatnonzero(valid)
+        segment = segment_of[start]
+        cumulative = np.concatenate(([0], np.cumsum(hist.counts)))
+        count = cumulative[start + window] - cumulative[start]
+        middle = hist.intervals[start + window // 2]
+    elif method == 'span':
+        # The count only changes where an interval enters or leaves the
+        # window, so only the smallest start and those need scoring
+        starts = np.concatenate((first_interval, hist.intervals - window,
+                                 hist.intervals + 1))
+        segment = np.concatenate((np.arange(n_pairs), segment_of, segment_of))
+        valid = ((starts >= first_interval[segment])
+                 & (starts < last_interval[segment]))
+        starts, segment = starts[valid], segment[valid]
+        order = np.lexsort((starts, segment))
+        starts, segment = starts[order], segment[order]
+        count = (_cumulative_counts(hist, segment, starts + window)
+                 - _cumulative_counts(hist, segment, starts - 1))
+        middle = (2 * starts + window) // 2
+    elif method == 'peak':
+        # Smallest interval with the highest count of each pair
+        peak = hist.intervals[_first_max(segment_of, hist.counts, n_pairs)]
+        best_interval[:] = peak
+        if window < 0:
+            return best_interval, best_percent
+        segment = np.repeat(np.arange(n_pairs), window + 1)
+        starts = peak[segment] - window + np.tile(np.arange(window + 1), n_pairs)
+        count = (_cumulative_counts(hist, segment, starts + window - 1)
+                 - _cumulative_counts(hist, segment, starts - 1))
+        middle = starts + window // 2
+    else:
+        raise ValueError(f"Unknown window method: {method}")
+
+    percent = count / hist.totals[segment] * 100
+    best = _first_max(segment, count, n_pairs)
+    # Only windows holding intervals beat the initial 0 percent
+    found = best >= 0
+    found[found] = count[best[found]] > 0
+    best_interval[found] = middle[best[found]]
+    best_percent[found] = percent[best[found]]
+    return best_interval, best_percent
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, Optional, Tuple
+
+
+def _composite(es, index, query, sources, aggs=None, page_size=1000):
+    """Page through all buckets of a composite aggregation."""
+    composite = {'size': page_size, 'sources': sources}
+    after = None
+    while True:
+        if after is not None:
+            composite['after'] = after
+        agg = {'composite': composite}
+        if aggs:
+            agg['aggs'] = aggs
+        resp = es.search(index=index, body={'size': 0, 'query': query, 'aggs': {'buckets': agg}})
+        result = resp['aggregations']['buckets']
+        yield from result['buckets']
+        after = result.get('after_key')
+        if not result['buckets'] or after is None:
+            return
+
+
+def frequent_pairs(es, index, query, sender_field, receiver_field, min_count,
+                   page_size=1000) -> Dict[Tuple[str, str], int]:
+    """Sender/receiver pairs with at least min_count emails.
+
+    Counted by a composite aggregation, so no email document leaves
+    Elasticsearch. Both fields must be keyword fields.
+
+    Args:
+        es: The Elasticsearch client.
+        index (str): The email index pattern.
+        query (dict): Query selecting the emails, e.g. the time range.
+        min_count (int): Pairs with fewer emails are dropped.
+
+    Returns:
+        Dict[Tuple[str, str], int]: Email count per (sender, receiver).
+    """
+    sources = [{'sender': {'terms': {'field': sender_field}}},
+               {'receiver': {'terms': {'field': receiver_field}}}]
+    return {(b['key']['sender'], b['key']['receiver']): b['doc_count']
+            for b in _composite(es, index, query, sources, page_size=page_size)
+            if b['doc_count'] >= min_count}
+
+
+def pair_histograms(es, index, query, pairs, sender_field, receiver_field, timestamp_field,
+                    size_field=None, resolution=2, page_size=1000, chunk_size=500) -> pd.DataFrame:
+    """Email counts of the given pairs per time bucket of resolution seconds.
+
+    Args:
+        es: The Elasticsearch client.
+        index (str): The email index pattern.
+        query (dict): Query selecting the emails, e.g. the time range.
+        pairs (List[Tuple[str, str]]): The (sender, receiver) pairs.
+        size_field (str): Field summed per bucket, if given.
+        resolution (int): Width of the time buckets in seconds.
+        chunk_size (int): Pairs per request, keep below max_clause_count.
+
+    Returns:
+        pd.DataFrame: sender, receiver, timestamp (bucket start in epoch
+            millis), count and size per non-empty bucket.
+    """
+    sources = [{'sender': {'terms': {'field': sender_field}}},
+               {'receiver': {'terms': {'field': receiver_field}}},
+               {'timestamp': {'date_histogram': {'field': timestamp_field,
+                                                 'fixed_interval': f"{max(1, int(resolution))}s"}}}]
+    aggs = {'size': {'sum': {'field': size_field}}} if size_field else None
+    wanted = set(pairs)
+    columns = {'sender': [], 'receiver': [], 'timestamp': [], 'count': [], 'size': []}
+    pairs = list(pairs)
+    for i in range(0, len(pairs), chunk_size):
+        chunk = pairs[i:i + chunk_size]
+        pair_query = {'bool': {
+            'filter': [query],
+            'should': [{'bool': {'filter': [{'term': {sender_field: s}},
+                                            {'term': {receiver_field: r}}]}}
+                       for s, r in chunk],
+            'minimum_should_match': 1,
+        }}
+        for b in _composite(es, index, pair_query, sources, aggs, page_size):
+            key = b['key']
+            # Emails to several receivers also bucket their other receivers
+            if (key['sender'], key['receiver']) not in wanted:
+                continue
+            columns['sender'].append(key['sender'])
+            columns['receiver'].append(key['receiver'])
+            columns['timestamp'].append(key['timestamp'])
+            columns['count'].append(b['doc_count'])
+            columns['size'].append(b['size']['value'] if aggs else np.nan)
+    return pd.DataFrame(columns)
+
+
+def fetch_pair_events(es, index, query, sender_field, receiver_field, timestamp_field,
+                      min_count, size_field=None, resolution=2,
+                      page_size=1000, chunk_size=500) -> Optional[pd.DataFrame]:
+    """Emails of the frequent pairs, pre-aggregated by Elasticsearch.
+
+    First finds the pairs with at least min_count emails, then fetches
+    their email counts per resolution seconds and expands every bucket to
+    one row per email at the bucket start. Intervals come out in steps of
+    resolution, sizes are averaged per bucket.
+
+    Returns:
+        pd.DataFrame: One row per email with the sender, receiver,
+            timestamp (epoch millis) and size fields, None if no pair
+            is frequent enough.
+    """
+    pairs = frequent_pairs(es, index, query, sender_field, receiver_field, min_count, page_size)
+    if not pairs:
+        return None
+    buckets = pair_histograms(es, index, query, pairs, sender_field, receiver_field,
+                              timestamp_field, size_field, resolution, page_size, chunk_size)
+    counts = buckets['count'].to_numpy()
+    data = pd.DataFrame({
+        sender_field: np.repeat(buckets['sender'].to_numpy(), counts),
+        receiver_field: np.repeat(buckets['receiver'].to_numpy(), counts),
+        timestamp_field: np.repeat(buckets['timestamp'].to_numpy(dtype=np.int64), counts),
+    })
+    if size_field:
+        data[size_field] = np.repeat(buckets['size'].to_numpy() / counts, counts)
+    return data
@@ -1,8 +1,11 @@
 import pandas as pd
 from elasticsearch import Elasticsearch, helpers
+from beacon_engine import NS_PER_SECOND, best_windows, epoch_nanoseconds, interval_histograms, pair_ids
+from es_fetch import fetch_pair_events
+from es_ingest import explode_receivers, ingest_emails
 
 class EmailBeaconDetector:
-    def __init__(self, es_host='localhost', es_port=9200, es_index='email-logs-*', min_occur=10, min_percent=5, window=2, period=24, min_interval=2):
+    def __init__(self, es_host='localhost', es_port=9200, es_index='email-logs-*', min_occur=10, min_percent=5, window=2, period=24, min_interval=2, fetch_mode='scan', slices=4):
         self.es_host = es_host
         self.es_port = es_port
         self.es_index = es_index
@@ -11,6 +14,10 @@ class EmailBeaconDetector:
         self.window = window
         self.period = period
         self.min_interval = min_interval
+        # 'scan' pulls every email, 'ingest' every email with `slices` parallel scrolls
+        # into a compact table, 'aggregate' only the frequent pairs' counts per min_interval
+        self.fetch_mode = fetch_mode
+        self.slices = slices
         self.es = Elasticsearch(self.es_host, port=self.es_port, timeout=60)
         self.data = self._fetch_data()
 
@@ -34,54 +41,47 @@ class EmailBeaconDetector:
             "_source": ["email.sender", "email.receiver", "@timestamp"]
         }
 
+        if self.fetch_mode == 'aggregate':
+            df = fetch_pair_events(self.es, self.es_index, query['query'], 'email.sender',
+                                   'email.receiver', '@timestamp', self.min_occur,
+                                   resolution=self.min_interval)
+            if df is None:
+                raise Exception("No email log data found for the specified period.")
+            return df
+        if self.fetch_mode == 'ingest':
+            df = ingest_emails(self.es, self.es_index, query['query'], 'email.sender',
+                               'email.receiver', '@timestamp', slices=self.slices)
+            if df.empty:
+                raise Exception("No email log data found for the specified period.")
+            return df
+
         resp = helpers.scan(query=query, client=self.es, index=self.es_index, scroll="10m", timeout="5m")
         records = [rec['_source'] for rec in resp]
         if not records:
             raise Exception("No email log data found for the specified period.")
         df = pd.DataFrame(records)
-        return df
-
-    def _percent_grouping(self, delta_counts, total):
-        max_percent = 0
-        best_interval = 0
-        keys = sorted(delta_counts.keys())
-        for i in range(len(keys) - self.window + 1):
-            window_keys = keys[i:i + self.window]
-            current = sum([delta_counts[k] for k in window_keys])
-            percent = (current / total) * 100
-            if percent > max_percent:
-                max_percent = percent
-                best_interval = window_keys[self.window // 2]
-        return best_interval, max_percent
+        # One row per receiver, like the ingest and aggregate modes
+        return explode_receivers(df, 'email.receiver')
 
     def detect_beaconing(self):
-        df = self.data.copy()
-        df['pair_id'] = (df['email.sender'] + df['email.receiver']).apply(hash)
-        df['@timestamp'] = pd.to_datetime(df['@timestamp'])
-        results = []
+        df = self.data
+        pair_id = pair_ids(df['email.sender'], df['email.receiver'])
+        codes, _ = pd.factorize(pair_id, sort=True)
+        # Interval histograms of all pairs at once, the first email of a pair counts as 0
+        hist = interval_histograms(codes, epoch_nanoseconds(df['@timestamp']),
+                                   self.min_interval, NS_PER_SECOND, keep_first=True)
+        # Best window of `window` consecutive distinct intervals per pair
+        interval, percent = best_windows(hist, self.window, 'keys')
+        beacon = (hist.totals >= self.min_occur) & (percent > self.min_percent)
+        rows = hist.first_rows[beacon]
 
-        for pair_id, group in df.groupby('pair_id'):
-            group = group.sort_values('@timestamp')
-            group['delta'] = group['@timestamp'].diff().dt.total_seconds().fillna(0).astype(int)
-            group = group[group['delta'] >= self.min_interval]
-            if group.empty:
-                continue
-            delta_counts = group['delta'].value_counts().to_dict()
-            total = sum(delta_counts.values())
-            if total < self.min_occur:
-                continue
-            interval, percent = self._percent_grouping(delta_counts, total)
-            if percent > self.min_percent:
-                sender = group['email.sender'].iloc[0]
-                receiver = group['email.receiver'].iloc[0]
-                results.append({
-                    'sender': sender,
-                    'receiver': receiver,
-                    'interval_seconds': interval,
-                    'beacon_percent': percent,
-                    'event_count': total
-                })
-        return pd.DataFrame(results)
+        return pd.DataFrame({
+            'sender': df['email.sender'].to_numpy()[rows],
+            'receiver': df['email.receiver'].to_numpy()[rows],
+            'interval_seconds': interval[beacon],
+            'beacon_percent': percent[beacon],
+            'event_count': hist.totals[beacon]
+        })
 
 # Example usage:
 # detector = EmailBeaconDetector()
@@ -1,5 +1,6 @@
 # coding: utf-8
 import sys
+import numpy as np
 import pandas as pd
 from elasticsearch import Elasticsearch, helpers, RequestsHttpConnection
 from multiprocessing import Process, JoinableQueue, Lock
@@ -8,6 +9,9 @@ import warnings
 import os
 import datetime
 import json
+from beacon_engine import NS_PER_SECOND, best_windows, epoch_nanoseconds, interval_histograms, pair_ids
+from es_fetch import fetch_pair_events
+from es_ingest import explode_receivers, ingest_emails
 
 warnings.filterwarnings('ignore')
 
@@ -28,7 +32,8 @@ class EmailBeaconDetector:
                  es_timeout=480,
                  es_index='email-logs-*',
                  kibana_version='4',
-                 verbose=True):
+                 verbose=True,
+                 fetch_mode='scan'):
         
         # Detection parameters
         self.MIN_OCCURRENCES = min_occur
@@ -52,6 +57,9 @@ class EmailBeaconDetector:
         self.timestamp_field = '@timestamp'
         
         self.verbose = verbose
+        # 'scan' pulls every email, 'ingest' every email with `threads` parallel scrolls
+        # into a compact table, 'aggregate' only the frequent pairs' counts per min_interval
+        self.fetch_mode = fetch_mode
         self._connect_elasticsearch()
 
     def _connect_elasticsearch(self):
@@ -96,31 +104,39 @@ class EmailBeaconDetector:
                        self.size_field, self.timestamp_field]
         }
 
-    def _calculate_intervals(self, data):
-        """Calculate time intervals between consecutive emails"""
-        data = data.sort_values(self.timestamp_field)
-        data['delta'] = (data[self.timestamp_field] - 
-                        data[self.timestamp_field].shift()).fillna(0)
-        return data[1:]  # Skip first row with NaN delta
-
     def detect_beacons(self):
         """Main detection workflow"""
-        # Execute ES query
-        response = helpers.scan(
-            client=self.es,
-            query=self._build_query(self.period),
-            index=self.es_index,
-            timeout="10m"
-        )
-        
-        # Process results
-        df = pd.json_normalize([hit['_source'] for hit in response])
-        if df.empty:
-            raise ValueError("No email data found in specified index")
+        if self.fetch_mode == 'aggregate':
+            # Pairs and their email counts are aggregated by Elasticsearch
+            df = fetch_pair_events(self.es, self.es_index, self._build_query(self.period)['query'],
+                                   self.sender_field, self.receiver_field, self.timestamp_field,
+                                   self.MIN_OCCURRENCES + 1, self.size_field, self.min_interval)
+            if df is None:
+                raise ValueError("No email data found in specified index")
+        elif self.fetch_mode == 'ingest':
+            df = ingest_emails(self.es, self.es_index, self._build_query(self.period)['query'],
+                               self.sender_field, self.receiver_field, self.timestamp_field,
+                               self.size_field, slices=self.NUM_PROCESSES)
+            if df.empty:
+                raise ValueError("No email data found in specified index")
+        else:
+            # Execute ES query
+            response = helpers.scan(
+                client=self.es,
+                query=self._build_query(self.period),
+                index=self.es_index,
+                timeout="10m"
+            )
+
+            # Process results
+            df = pd.json_normalize([hit['_source'] for hit in response])
+            if df.empty:
+                raise ValueError("No email data found in specified index")
+            # One row per receiver, like the ingest and aggregate modes
+            df = explode_receivers(df, self.receiver_field)
             
         # Create unique communication pairs
-        df['pair_id'] = (df[self.sender_field] + 
-                        df[self.receiver_field]).apply(hash)
+        df['pair_id'] = pair_ids(df[self.sender_field], df[self.receiver_field])
         df['pair_freq'] = df.groupby('pair_id')['pair_id'].transform('count')
         
         # Filter frequent pairs
@@ -130,49 +146,27 @@ class EmailBeaconDetector:
     def _analyze_temporal_patterns(self, data):
         """Analyze temporal patterns for frequent email pairs"""
         results = []
-        
-        for pair_id, group in data.groupby('pair_id'):
-            timed_data = self._calculate_intervals(group)
-            intervals = timed_data['delta'].value_counts().to_dict()
-            
-            # Filter short intervals
-            intervals = {k:v for k,v in intervals.items() 
-                        if k >= self.min_interval}
-            
-            total = sum(intervals.values())
-            if total < self.MIN_OCCURRENCES:
-                continue
-                
-            # Calculate pattern metrics
-            interval, confidence = self._calculate_pattern_confidence(intervals, total)
-            if confidence >= self.MIN_PERCENT:
-                results.append({
-                    'sender': group[self.sender_field].iloc[0],
-                    'receiver': group[self.receiver_field].iloc[0],
-                    'total_emails': total,
-                    'average_size': group[self.size_field].mean(),
-                    'detected_interval': interval,
-                    'confidence': f"{confidence:.1f}%"
-                })
-        
-        return pd.DataFrame(results)
+        codes, _ = pd.factorize(data['pair_id'], sort=True)
+        # Intervals in whole seconds between consecutive emails of all pairs at once
+        hist = interval_histograms(codes, epoch_nanoseconds(data[self.timestamp_field]),
+                                   self.min_interval, NS_PER_SECOND)
+        average_sizes = data[self.size_field].groupby(codes).mean()
 
-    def _calculate_pattern_confidence(self, intervals, total):
-        """Calculate pattern confidence using sliding window"""
-        max_confidence = 0
-        best_interval = 0
+        # Calculate pattern metrics, windows [s, s + WINDOW] from the smallest interval on
+        interval, confidence = best_windows(hist, self.WINDOW, 'span')
+        frequent = hist.totals >= self.MIN_OCCURRENCES
+        for i in np.flatnonzero(frequent & (confidence >= self.MIN_PERCENT)):
+            row = hist.first_rows[i]
+            results.append({
+                'sender': data[self.sender_field].iloc[row],
+                'receiver': data[self.receiver_field].iloc[row],
+                'total_emails': int(hist.totals[i]),
+                'average_size': average_sizes[hist.pairs[i]],
+                'detected_interval': int(interval[i]),
+                'confidence': f"{confidence[i]:.1f}%"
+            })
         
-        for window_start in range(min(intervals.keys()), max(intervals.keys())):
-            window_end = window_start + self.WINDOW
-            window_count = sum(v for k,v in intervals.items() 
-                             if window_start <= k <= window_end)
-            
-            confidence = (window_count / total) * 100
-            if confidence > max_confidence:
-                max_confidence = confidence
-                best_interval = (window_start + window_end) // 2
-                
-        return best_interval, max_confidence
+        return pd.DataFrame(results)
 
 if __name__ == "__main__":
     detector = EmailBeaconDetector(
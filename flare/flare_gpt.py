@@ -1,15 +1,59 @@
 import sys
+import numpy as np
 import pandas as pd
 from elasticsearch import Elasticsearch, helpers
-from multiprocessing import Process, JoinableQueue, Lock, Manager
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 import time
 import datetime
 import json
 import warnings
 
+from beacon_engine import NS_PER_SECOND, best_windows, delta_histograms, epoch_nanoseconds, pair_ids
+from es_fetch import fetch_pair_events
+from es_ingest import explode_receivers, ingest_emails
+
 warnings.filterwarnings('ignore')
 
 
+def scan_triads(shm_names, n_rows, bounds, min_interval, min_occur, min_percent, window):
+    """Score a contiguous range of triads in a worker process.
+
+    The epoch and size columns, sorted by (triad, epoch), are attached
+    from shared memory, bounds holds the row offsets of the triads.
+    Returns [row of the first interval, size_total, total, percent, interval]
+    per beacon.
+    """
+    blocks = [SharedMemory(name=name) for name in shm_names]
+    try:
+        epoch = np.ndarray(n_rows, dtype=np.int64, buffer=blocks[0].buf)
+        size = np.ndarray(n_rows, dtype=np.float64, buffer=blocks[1].buf)
+        start, end = bounds[0], bounds[-1]
+        triad = np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+        delta = np.zeros(end - start, dtype=np.int64)
+        delta[1:] = np.diff(epoch[start:end])
+        first = np.ones(len(triad), dtype=bool)
+        first[1:] = triad[1:] != triad[:-1]
+        delta[first] = 0
+        keep = delta >= min_interval
+        kept = np.flatnonzero(keep)
+        size_total = np.bincount(triad[keep], weights=np.nan_to_num(size[start:end][keep]),
+                                 minlength=len(bounds) - 1)
+        # Drop the views before the blocks are closed
+        del epoch, size
+
+        # Windows of `window` seconds around the most frequent interval
+        hist = delta_histograms(triad[keep], delta[keep])
+        interval, percent = best_windows(hist, window, 'peak')
+        beacon = np.flatnonzero((hist.totals > min_occur) & (percent > min_percent))
+        return [[start + int(kept[hist.first_rows[i]]), float(size_total[hist.pairs[i]]),
+                 int(hist.totals[i]), int(percent[i]), int(interval[i])]
+                for i in beacon]
+    finally:
+        for block in blocks:
+            block.close()
+
+
 class EmailBeaconDetector:
     def __init__(self,
                  es_host='localhost',
@@ -22,7 +66,8 @@ class EmailBeaconDetector:
                  min_interval=2,
                  threads=4,
                  es_timeout=480,
-                 verbose=True):
+                 verbose=True,
+                 fetch_mode='scan'):
         self.es = Elasticsearch(hosts=[{'host': es_host, 'port': es_port}], timeout=es_timeout)
         self.es_index = es_index
         self.period = period
@@ -32,16 +77,15 @@ class EmailBeaconDetector:
         self.min_interval = min_interval
         self.threads = threads
         self.verbose = verbose
+        # 'scan' pulls every email, 'ingest' every email with `threads` parallel scrolls
+        # into a compact table, 'aggregate' only the frequent triads' counts per min_interval
+        self.fetch_mode = fetch_mode
 
         self.timestamp_field = '@timestamp'
         self.sender_field = 'email.sender'
         self.receiver_field = 'email.receiver'
         self.size_field = 'email.size'
 
-        self.q_job = JoinableQueue()
-        self.l_df = Lock()
-        self.l_list = Lock()
-
         self.fields = [self.sender_field, self.receiver_field, self.size_field,
                        'occurrences', 'percent', 'interval']
         self.high_freq = None
@@ -82,78 +126,86 @@ class EmailBeaconDetector:
             ]
         }
 
-        resp = helpers.scan(client=self.es, index=self.es_index, query=query, scroll="60m", timeout="10m")
-        data = pd.json_normalize([doc['_source'] for doc in resp])
-
-        if data.empty:
+        if self.fetch_mode == 'aggregate':
+            data = fetch_pair_events(self.es, self.es_index, query['query'], self.sender_field,
+                                     self.receiver_field, self.timestamp_field, self.min_occur + 1,
+                                     self.size_field, self.min_interval)
+        elif self.fetch_mode == 'ingest':
+            # One row per receiver already
+            data = ingest_emails(self.es, self.es_index, query['query'], self.sender_field,
+                                 self.receiver_field, self.timestamp_field, self.size_field,
+                                 slices=self.threads)
+        else:
+            resp = helpers.scan(client=self.es, index=self.es_index, query=query, scroll="60m", timeout="10m")
+            data = pd.json_normalize([doc['_source'] for doc in resp])
+
+        if data is None or data.empty:
             raise Exception("No data retrieved. Check index name and field mappings.")
 
         # Check if receiver field exists and is a list
-        if self.receiver_field in data.columns:
-            # Explode the receiver list into separate rows
-            data = data.explode(self.receiver_field)
-            data.reset_index(drop=True, inplace=True)
+        if self.fetch_mode == 'scan' and self.receiver_field in data.columns:
+            # Explode the receiver list into separate rows, like the other modes
+            data = explode_receivers(data, self.receiver_field)
 
-        data['triad_id'] = (data[self.sender_field] + data[self.receiver_field]).apply(hash)
+        data['triad_id'] = pair_ids(data[self.sender_field], data[self.receiver_field])
         data['triad_freq'] = data.groupby('triad_id')['triad_id'].transform('count')
         self.high_freq = list(data[data.triad_freq > self.min_occur].groupby('triad_id').groups.keys())
         return data
 
-    def percent_grouping(self, delta_counts, total):
-        max_interval = max(delta_counts, key=delta_counts.get)
-        best_window = max_interval
-        best_percent = 0.0
-
-        for i in range(max_interval - self.window, max_interval + 1):
-            current = sum(delta_counts.get(j, 0) for j in range(i, i + self.window))
-            percent = (current / total) * 100
-            if percent > best_percent:
-                best_percent = percent
-                best_window = i + self.window // 2
-
-        return best_window, best_percent
-
-    def find_beacon(self, q_job, result_list):
-        while not q_job.empty():
-            triad_id = q_job.get()
-            with self.l_df:
-                df = self.email_data[self.email_data.triad_id == triad_id].copy()
-
-            df[self.timestamp_field] = pd.to_datetime(df[self.timestamp_field])
-            df['epoch'] = (df[self.timestamp_field].astype(int) / 1e9).astype(int)
-            df = df.sort_values('epoch')
-            df['delta'] = df['epoch'].diff().fillna(0)
-            df = df[df['delta'] >= self.min_interval]
-
-            delta_counts = dict(df['delta'].value_counts())
-            total = sum(delta_counts.values())
-
-            if total > self.min_occur:
-                interval, percent = self.percent_grouping(delta_counts, total)
-                if percent > self.min_percent:
-                    sender = df[self.sender_field].iloc[0]
-                    receiver = df[self.receiver_field].iloc[0]
-                    size_total = df[self.size_field].sum() if self.size_field in df else 0
-                    with self.l_list:
-                        result_list.append([sender, receiver, size_total, total, int(percent), interval])
-
-            q_job.task_done()
+    def partition(self):
+        """Sort the rows of the frequent triads by (triad, epoch) once.
+
+        Returns the sorted rows and the row offsets of each triad.
+        """
+        data = self.email_data[self.email_data.triad_id.isin(self.high_freq)]
+        codes, _ = pd.factorize(data['triad_id'], sort=True)
+        epoch = epoch_nanoseconds(data[self.timestamp_field]) // NS_PER_SECOND
+        order = np.lexsort((epoch, codes))
+        data = data.iloc[order]
+        bounds = np.searchsorted(codes[order], np.arange(len(self.high_freq) + 1))
+        return data, epoch[order], bounds
+
+    def find_beacon(self, data, epoch, bounds):
+        """Score all triads in worker processes sharing the sorted columns."""
+        n_rows = len(epoch)
+        if self.size_field in data:
+            size = data[self.size_field].to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            size = np.zeros(n_rows)
+        blocks = []
+        try:
+            for column in (epoch, size):
+                block = SharedMemory(create=True, size=max(column.nbytes, 1))
+                np.ndarray(n_rows, dtype=column.dtype, buffer=block.buf)[:] = column
+                blocks.append(block)
+
+            # Contiguous triad ranges of about equal row counts, a few per worker
+            n_tasks = max(1, min(len(bounds) - 1, self.threads * 4))
+            cuts = np.searchsorted(bounds, np.linspace(0, n_rows, n_tasks + 1))
+            cuts[0], cuts[-1] = 0, len(bounds) - 1
+            cuts = np.unique(cuts)
+            tasks = [([b.name for b in blocks], n_rows, bounds[lo:hi + 1],
+                      self.min_interval, self.min_occur, self.min_percent, self.window)
+                     for lo, hi in zip(cuts[:-1], cuts[1:])]
+
+            # Workers only attach the shared columns and never touch the DataFrame
+            with Pool(self.threads) as pool:
+                chunks = pool.starmap(scan_triads, tasks)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return [row for chunk in chunks for row in chunk]
 
     def detect_beacons(self, csv_out=None):
-        for triad_id in self.high_freq:
-            self.q_job.put(triad_id)
-
-        manager = Manager()
-        result_list = manager.list()
-
-        processes = [Process(target=self.find_beacon, args=(self.q_job, result_list)) for _ in range(self.threads)]
-
-        for p in processes:
-            p.start()
-        for p in processes:
-            p.join()
-
-        df = pd.DataFrame(list(result_list), columns=self.fields)
+        data, epoch, bounds = self.partition()
+        rows = self.find_beacon(data, epoch, bounds)
+
+        senders = data[self.sender_field].to_numpy()
+        receivers = data[self.receiver_field].to_numpy()
+        result_list = [[senders[first], receivers[first], size_total, total, percent, interval]
+                       for first, size_total, total, percent, interval in rows]
+        df = pd.DataFrame(result_list, columns=self.fields)
 
         if csv_out:
             self.log(f"Saving results to {csv_out}")
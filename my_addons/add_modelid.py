@@ -1,29 +1,42 @@
-import json
 import logging
+from typing import Any, Dict
+from mitmproxy.http import HTTPFlow
+from my_addons.body_pipeline import BodyPipeline
 
 MODEL_NAME = "TheBloke/Llama-2-13B-chat-AWQ"
 
 
 class AddModelId(object):
-    def __init__(self, model_name=MODEL_NAME):
+    def __init__(self, model_name=MODEL_NAME, dump_headers=False):
         self.model_name = model_name
+        self.dump_headers = dump_headers
 
-    def request(self, flow):
-        # Add the field "model": self.model_name to the request body
-        if flow.request.method == "POST":
+    def transform(self, flow: HTTPFlow, body: Dict[str, Any]) -> bool:
+        """Add the field "model": self.model_name to the request body.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+            body (Dict[str, Any]): The decoded request body.
+
+        Returns:
+            bool: Whether the body changed.
+        """
+        if flow.request.method != "POST":
+            return False
+        headers = flow.request.headers
+        logging.debug(headers)
+        if self.dump_headers:
             # Save headers
-            headers = flow.request.headers
-            logging.info(headers)
             with open("headers.txt", "w") as f:
                 f.write(str(headers))
-            try:
-                data = json.loads(flow.request.content.decode("utf-8"))
-                # if "model" not in data:
-                data["model"] = self.model_name
-                # logging.info(data)
-                flow.request.content = json.dumps(data).encode("utf-8")
-            except Exception as e:
-                logging.error(e)
+        # if "model" not in data:
+        if body.get("model") == self.model_name:
+            return False
+        body["model"] = self.model_name
+        return True
+
+    def request(self, flow):
+        BodyPipeline([self]).request(flow)
 
 
 addons = [AddModelId()]
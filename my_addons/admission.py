@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from mitmproxy.http import HTTPFlow, Response
+from my_addons.body_pipeline import json_body
+
+ADMITTED = "admitted"
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+
+class Gate(object):
+    """Concurrency slots and waiting flows of one upstream and model."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        # (priority, arrival, future), lowest first
+        self.waiting: List[Tuple[int, int, asyncio.Future]] = []
+
+    def hand_over(self) -> None:
+        """Pass free slots to the next waiting flows."""
+        while self.waiting and self.active < self.limit:
+            _, _, waiter = heapq.heappop(self.waiting)
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(True)
+
+    def discard(self, waiter: asyncio.Future) -> None:
+        """Drop a flow that timed out or whose client went away."""
+        self.waiting = [entry for entry in self.waiting if entry[2] is not waiter]
+        heapq.heapify(self.waiting)
+
+
+class AdmissionControl(object):
+    """Mitmproxy addon bounding the concurrent requests per upstream and model.
+
+    Requests beyond max_concurrency wait in a priority queue, interactive
+    clients ahead of batch ones, and are answered with 429 and Retry-After
+    once max_queue flows are waiting or they waited longer than
+    queue_timeout. The priority is read from the X-Priority header
+    ("interactive" or "batch") or derived from batch_paths. Add it after the
+    LoadBalancer, so the limits apply to the selected backend.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        model_limits: Optional[Dict[str, int]] = None,
+        max_queue: int = 64,
+        queue_timeout: float = 60,
+        retry_after: int = 5,
+        priority_header: str = "X-Priority",
+        batch_paths: Tuple[str, ...] = (),
+        default_priority: str = "interactive",
+    ):
+        """
+        Args:
+            max_concurrency (int): Concurrent requests per upstream and model.
+            model_limits (Dict[str, int]): Overrides of max_concurrency per model.
+            max_queue (int): Waiting requests per upstream and model before
+                shedding load.
+            queue_timeout (float): Seconds a request may wait for a slot.
+            retry_after (int): Seconds advertised in the Retry-After header.
+            priority_header (str): Request header carrying the priority.
+            batch_paths (Tuple[str, ...]): Path prefixes treated as batch.
+            default_priority (str): Priority of requests without either.
+        """
+        self.max_concurrency = max_concurrency
+        self.model_limits = model_limits or {}
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.priority_header = priority_header
+        self.batch_paths = batch_paths
+        self.default_priority = default_priority
+        self.gates: Dict[Tuple[str, str], Gate] = {}
+        self._arrivals = itertools.count()
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def priority(self, flow: HTTPFlow) -> int:
+        """Rank of a flow in the queue, lower goes first.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+
+        Returns:
+            int: The rank.
+        """
+        name = flow.request.headers.get(self.priority_header, "").lower()
+        if name not in PRIORITIES:
+            path = flow.request.path
+            batch = any(path.startswith(prefix) for prefix in self.batch_paths)
+            name = "batch" if batch else self.default_priority
+        return PRIORITIES.get(name, 0)
+
+    async def request(self, flow: HTTPFlow) -> None:
+        """Admit the flow, park it until a slot frees up, or shed it.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+        """
+        if flow.response is not None:
+            # Answered by the proxy, e.g. from the cache
+            return
+        model = str((json_body(flow) or {}).get("model", ""))
+        key = (f"{flow.request.host}:{flow.request.port}", model)
+        gate = self.gates.get(key)
+        if gate is None:
+            limit = self.model_limits.get(model, self.max_concurrency)
+            gate = self.gates[key] = Gate(limit)
+
+        if gate.active < gate.limit and not gate.waiting:
+            gate.active += 1
+            self._admit(flow, key, 0.0)
+            return
+        if len(gate.waiting) >= self.max_queue:
+            self.rejected += 1
+            self._reject(flow, "queue full")
+            return
+
+        self.queued += 1
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            gate.waiting, (self.priority(flow), next(self._arrivals), waiter)
+        )
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            gate.discard(waiter)
+            self.timed_out += 1
+            self._reject(flow, "queue timeout")
+            return
+        except asyncio.CancelledError:
+            gate.discard(waiter)
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just before the client went away
+                gate.active -= 1
+                gate.hand_over()
+            raise
+        self._admit(flow, key, time.monotonic() - start)
+
+    def response(self, flow: HTTPFlow) -> None:
+        self._release(flow)
+
+    def error(self, flow: HTTPFlow) -> None:
+        self._release(flow)
+
+    def stats(self) -> Dict[str, float]:
+        """Counters and queue lengths. The gates are only changed on the
+        event loop, so read it there, as ProxyMetrics does."""
+        return {
+            "active": sum(gate.active for gate in self.gates.values()),
+            "waiting": sum(len(gate.waiting) for gate in self.gates.values()),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_total": self.wait_total,
+            "wait_seconds_max": self.wait_max,
+        }
+
+    def done(self) -> None:
+        logging.info(f"AdmissionControl: {self.stats()}")
+
+    def _admit(self, flow: HTTPFlow, key: Tuple[str, str], waited: float) -> None:
+        flow.metadata[ADMITTED] = key
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def _reject(self, flow: HTTPFlow, reason: str) -> None:
+        logging.warning(f"Shedding request to {flow.request.host}: {reason}")
+        flow.response = Response.make(
+            429,
+            f"Upstream overloaded ({reason}), retry later".encode("utf-8"),
+            {"Content-Type": "text/plain", "Retry-After": str(self.retry_after)},
+        )
+
+    def _release(self, flow: HTTPFlow) -> None:
+        gate = self.gates.get(flow.metadata.pop(ADMITTED, None))
+        if gate is None:
+            return
+        gate.active -= 1
+        gate.hand_over()
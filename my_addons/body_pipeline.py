@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from mitmproxy.http import HTTPFlow
+
+JSON_BODY = "json_body"
+
+
+def json_body(flow: HTTPFlow) -> Optional[Dict[str, Any]]:
+    """The request body decoded by the BodyPipeline, None if it was not JSON."""
+    return flow.metadata.get(JSON_BODY)
+
+
+def canonical_key(flow: HTTPFlow) -> Optional[str]:
+    """Hash the method, path and canonical JSON of the transformed request
+    body, so requests differing only in key order or whitespace match.
+
+    Returns:
+        Optional[str]: The hex digest, None if the body is not JSON.
+    """
+    body = json_body(flow)
+    if body is None:
+        return None
+    encoded = json.dumps(
+        [flow.request.method, flow.request.path, body],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class BodyPipeline(object):
+    """Mitmproxy addon decoding the JSON request body once per flow,
+    passing it through the registered transforms and encoding it
+    again only if one of them changed it.
+
+    A transform is any object with a `transform(flow, body) -> bool`
+    method that edits the body in place and returns whether it did.
+    The decoded body is kept in the flow metadata for later addons.
+    """
+
+    def __init__(self, transforms: List[Any]):
+        self.transforms = transforms
+        self.timings: Dict[str, float] = {}
+        self.requests = 0
+
+    def request(self, flow: HTTPFlow) -> None:
+        """Decode the request body, run the transforms and re-encode it.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+        """
+        start = time.perf_counter()
+        try:
+            body = json.loads(flow.request.content.decode("utf-8"))
+        except Exception as e:
+            logging.debug(f"Request body is not JSON: {e}")
+            return
+        if not isinstance(body, dict):
+            return
+        self._record("decode", start)
+
+        changed = False
+        for transform in self.transforms:
+            start = time.perf_counter()
+            try:
+                changed |= bool(transform.transform(flow, body))
+            except Exception as e:
+                logging.error(e)
+            self._record(type(transform).__name__, start)
+
+        if changed:
+            start = time.perf_counter()
+            flow.request.content = json.dumps(body).encode("utf-8")
+            self._record("encode", start)
+        flow.metadata[JSON_BODY] = body
+        self.requests += 1
+
+    def done(self) -> None:
+        if self.requests:
+            per_request = {
+                stage: f"{seconds / self.requests * 1000:.3f}ms"
+                for stage, seconds in self.timings.items()
+            }
+            logging.info(f"BodyPipeline time per request: {per_request}")
+
+    def _record(self, stage: str, start: float) -> None:
+        self.timings[stage] = self.timings.get(stage, 0.0) + (
+            time.perf_counter() - start
+        )
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from mitmproxy.http import HTTPFlow, Response
+from my_addons.body_pipeline import canonical_key, json_body
+from my_addons.sse import is_event_stream, stream_complete, tee_response, teed_body
+
+COALESCE_KEY = "coalesce_key"
+COALESCED = "coalesced"
+
+
+class Coalescer(object):
+    """Mitmproxy addon sending identical in-flight requests upstream only once.
+
+    The first request for a canonical body (after the BodyPipeline) is the
+    leader and goes upstream untouched. Requests arriving while it is in
+    flight wait for it and are answered with its response. If the leader
+    fails or takes longer than timeout, one waiting request is promoted to
+    leader and goes upstream, the others keep waiting on it.
+
+    Streamed responses of leaders are tee'd and replayed to the followers
+    as the same SSE stream. mitmproxy cannot stream a locally made response,
+    so a streaming follower gets all chunks at once when the leader
+    finishes: its time to first token becomes the leader's total time, in
+    exchange for no upstream call of its own. Set coalesce_streams=False
+    where that latency matters more than the upstream load.
+    """
+
+    def __init__(self, timeout: float = 300, coalesce_streams: bool = True):
+        """
+        Args:
+            timeout (float): Seconds followers wait for a leader before
+                one of them takes over.
+            coalesce_streams (bool): Also coalesce requests with stream set.
+        """
+        self.timeout = timeout
+        self.coalesce_streams = coalesce_streams
+        self.leaders = 0
+        self.followers = 0
+        self.promotions = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def request(self, flow: HTTPFlow) -> None:
+        """Let the first request through and park identical ones.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+        """
+        if flow.response is not None or flow.request.method != "POST":
+            return
+        body = json_body(flow)
+        if body is None or (body.get("stream") and not self.coalesce_streams):
+            return
+        key = canonical_key(flow)
+        if key is None:
+            return
+        leader = self._inflight.get(key)
+        if leader is None:
+            self._lead(flow, key)
+            self.leaders += 1
+            return
+
+        self.followers += 1
+        while True:
+            try:
+                # Shielded, so a timed out follower does not cancel the others
+                result = await asyncio.wait_for(asyncio.shield(leader), self.timeout)
+            except asyncio.TimeoutError:
+                result = None
+                if self._inflight.get(key) is leader:
+                    # Take over from the stalled leader, release its followers
+                    self._inflight.pop(key)
+                    leader.set_result(None)
+            if result is not None:
+                break
+            leader = self._inflight.get(key)
+            if leader is None:
+                # The first follower to wake up replaces the failed leader
+                self._lead(flow, key)
+                self.promotions += 1
+                return
+        status_code, content_type, body = result
+        flow.response = Response.make(status_code, body, {"content-type": content_type})
+        flow.metadata[COALESCED] = True
+        logging.info(f"Coalesced {flow.id} onto {key[:12]}")
+
+    def responseheaders(self, flow: HTTPFlow) -> None:
+        """Capture the streamed response of leaders.
+
+        Args:
+            flow (HTTPFlow): The flow.
+        """
+        if COALESCE_KEY in flow.metadata and is_event_stream(flow.response):
+            tee_response(flow)
+
+    def response(self, flow: HTTPFlow) -> None:
+        """Fan the response of a leader out to its followers.
+
+        Args:
+            flow (HTTPFlow): The response flow.
+        """
+        result: Optional[Tuple[int, str, bytes]] = None
+        if flow.response.status_code == 200:
+            content_type = flow.response.headers.get(
+                "content-type", "application/json"
+            )
+            teed = teed_body(flow)
+            body = teed if teed is not None else flow.response.content or b""
+            # A stream cut off upstream is not handed on, a follower retries
+            if teed is None or stream_complete(teed):
+                result = (flow.response.status_code, content_type, body)
+        self._resolve(flow, result)
+
+    def error(self, flow: HTTPFlow) -> None:
+        """Hand the followers of a failed leader over to a new one.
+
+        Args:
+            flow (HTTPFlow): The failed flow.
+        """
+        self._resolve(flow, None)
+
+    def _lead(self, flow: HTTPFlow, key: str) -> None:
+        leader = asyncio.get_running_loop().create_future()
+        self._inflight[key] = leader
+        flow.metadata[COALESCE_KEY] = (key, leader)
+
+    def _resolve(self, flow: HTTPFlow, result: Optional[Tuple[int, str, bytes]]):
+        entry = flow.metadata.pop(COALESCE_KEY, None)
+        if entry is None:
+            return
+        key, leader = entry
+        # A leader that was taken over no longer owns the key
+        if self._inflight.get(key) is leader:
+            del self._inflight[key]
+        if not leader.done():
+            leader.set_result(result)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "promotions": self.promotions,
+        }
+
+    def done(self) -> None:
+        logging.info(f"Coalescer: {self.stats()}")
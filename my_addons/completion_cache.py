@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from mitmproxy.http import HTTPFlow, Response
+from my_addons.body_pipeline import canonical_key
+from my_addons.sse import is_event_stream, tee_response, teed_body
+
+CACHE_PATH = pathlib.Path("data/completion_cache/")
+CACHE_KEY = "cache_key"
+CACHE_HIT = "cache_hit"
+
+
+class CompletionStore(object):
+    """On-disk store of response bodies with size and TTL eviction.
+
+    The index of entries is kept in memory, so misses never touch the disk.
+    """
+
+    def __init__(self, cache_path: pathlib.Path, max_bytes: int, ttl: float):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> (last used, stored at, size)
+        self._index: Dict[str, Tuple[float, float, int]] = {}
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        for path in self.cache_path.glob("*.bin"):
+            stat = path.stat()
+            self._index[path.stem] = (stat.st_mtime, stat.st_mtime, stat.st_size)
+        self.resident_bytes = sum(size for _, _, size in self._index.values())
+
+    def get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        """Look up a response.
+
+        Returns:
+            Optional[Tuple[str, bytes]]: Content type and body, None on a miss.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            now = time.time()
+            if now - entry[1] > self.ttl:
+                self._remove(key)
+                return None
+            self._index[key] = (now, entry[1], entry[2])
+        try:
+            content_type, body = self._path(key).read_bytes().split(b"\n", 1)
+        except (OSError, ValueError):
+            return None
+        return content_type.decode("utf-8"), body
+
+    def put(self, key: str, content_type: str, body: bytes) -> None:
+        """Store a response and evict the least recently used ones
+        above max_bytes."""
+        data = content_type.encode("utf-8") + b"\n" + body
+        tmp_path = self._path(key).with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        with self._lock:
+            if key in self._index:
+                self._remove(key)
+            os.replace(tmp_path, self._path(key))
+            now = time.time()
+            self._index[key] = (now, now, len(data))
+            self.resident_bytes += len(data)
+            if self.resident_bytes > self.max_bytes:
+                by_use = sorted(self._index.items(), key=lambda entry: entry[1][0])
+                for old_key, _ in by_use:
+                    if self.resident_bytes <= self.max_bytes:
+                        break
+                    self._remove(old_key)
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.cache_path.joinpath(f"{key}.bin")
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self._index.pop(key)
+        self.resident_bytes -= size
+        self.evictions += 1
+        try:
+            self._path(key).unlink()
+        except OSError as e:
+            logging.error(e)
+
+
+class CompletionCache(object):
+    """Mitmproxy addon answering repeated chat completion requests
+    from a local cache instead of the upstream LLM.
+
+    Requests are keyed on their canonical body after the BodyPipeline,
+    so it has to come after it in the addon list. Streamed responses
+    are captured with a tee and replayed as the same SSE stream.
+    """
+
+    def __init__(
+        self,
+        cache_path: pathlib.Path = CACHE_PATH,
+        max_bytes: int = 512 * 1024 * 1024,
+        ttl: float = 24 * 3600,
+    ):
+        """
+        Args:
+            cache_path (pathlib.Path): Directory of the cached responses.
+            max_bytes (int): Size above which the least recently used
+                responses are evicted.
+            ttl (float): Seconds after which a response expires.
+        """
+        self.store = CompletionStore(cache_path, max_bytes, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    async def request(self, flow: HTTPFlow) -> None:
+        """Answer the request from the cache on a hit, reading it
+        off the event loop.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+        """
+        if flow.response is not None or flow.request.method != "POST":
+            return
+        key = canonical_key(flow)
+        if key is None:
+            return
+        cached = await asyncio.get_running_loop().run_in_executor(
+            None, self.store.get, key
+        )
+        if cached is None:
+            self.misses += 1
+            flow.metadata[CACHE_KEY] = key
+            return
+        content_type, body = cached
+        self.hits += 1
+        self.bytes_saved += len(body)
+        flow.metadata[CACHE_HIT] = True
+        flow.response = Response.make(200, body, {"content-type": content_type})
+        logging.info(f"Cache hit {key[:12]} for {flow.id}")
+
+    def responseheaders(self, flow: HTTPFlow) -> None:
+        """Capture streamed responses of cache misses.
+
+        Args:
+            flow (HTTPFlow): The flow.
+        """
+        if CACHE_KEY in flow.metadata and is_event_stream(flow.response):
+            tee_response(flow)
+
+    def response(self, flow: HTTPFlow) -> None:
+        """Store successful responses of cache misses, off the event loop.
+
+        Args:
+            flow (HTTPFlow): The response flow.
+        """
+        key = flow.metadata.get(CACHE_KEY)
+        if key is None or flow.response.status_code != 200:
+            return
+        body = teed_body(flow) or flow.response.content
+        if not body:
+            return
+        content_type = flow.response.headers.get("content-type", "application/json")
+        asyncio.get_running_loop().run_in_executor(
+            None, self.store.put, key, content_type, body
+        )
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "resident_bytes": self.store.resident_bytes,
+            "evictions": self.store.evictions,
+        }
+
+    def done(self) -> None:
+        logging.info(f"CompletionCache: {self.stats()}")
@@ -3,7 +3,10 @@ import logging
 import pathlib
 from mitmproxy.http import HTTPFlow
 from datetime import datetime
-from addict import Dict
+from my_addons.body_pipeline import json_body
+from my_addons.flow_store import FlowStore
+from my_addons.segment_writer import SegmentWriter
+from my_addons.sse import assemble_completion, is_event_stream, tee_response, teed_body
 
 DUMP_PATH = pathlib.Path("data/")
 DUMP_PATH.mkdir(exist_ok=True)
@@ -12,12 +15,57 @@ DUMP_PATH.mkdir(exist_ok=True)
 class DumpBody(object):
     """Mitmproxy addon to dump the body
     from requests and responses to the OpenAI API.
+    Flows are appended as NDJSON records to rotating segments
+    by a background writer. With stream_responses, streamed responses
+    pass straight through and the SSE deltas are reassembled for the dump.
+    Requests waiting for their response are kept in a bounded FlowStore.
     """
 
-    def __init__(self):
-        self.dump_path = DUMP_PATH
-        self.flow_data = Dict()
-        pass
+    def __init__(
+        self,
+        dump_path: pathlib.Path = DUMP_PATH,
+        max_segment_bytes: int = 64 * 1024 * 1024,
+        compress: bool = False,
+        stream_responses: bool = False,
+        max_flows: int = 1000,
+        max_flow_bytes: int = 256 * 1024 * 1024,
+        flow_ttl: float = 600,
+    ):
+        self.dump_path = dump_path
+        self.stream_responses = stream_responses
+        self.flow_data = FlowStore(
+            max_entries=max_flows,
+            max_bytes=max_flow_bytes,
+            ttl=flow_ttl,
+        )
+        self.writer = SegmentWriter(
+            dump_path,
+            max_bytes=max_segment_bytes,
+            compress=compress,
+        )
+
+    def done(self) -> None:
+        """Flush the pending dumps on shutdown."""
+        logging.info(f"DumpBody flow store: {self.flow_data.stats()}")
+        self.writer.close()
+
+    def error(self, flow: HTTPFlow) -> None:
+        """Dump the request of a failed flow with the error
+        and release its state.
+
+        Args:
+            flow (HTTPFlow): The failed flow.
+        """
+        request = self.flow_data.pop(flow.id)
+        if request is not None:
+            self.writer.submit(
+                {
+                    "id": flow.id,
+                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "request": request,
+                    "error": str(flow.error),
+                }
+            )
 
     def handle_flow(self, flow: HTTPFlow, type: str) -> None:
         """If the request is a POST request, dump the body.
@@ -30,13 +78,24 @@ class DumpBody(object):
             stream_id = flow.id
             if type == "response":
                 frame = flow.response
+                raw = teed_body(flow)
+                if raw is not None:
+                    self.dump_body(assemble_completion(raw), stream_id, type)
+                    return
             else:
                 frame = flow.request
+                body = json_body(flow)
+                if body is not None:
+                    # Already decoded by the BodyPipeline
+                    size = len(frame.content or b"")
+                    self.dump_body(body, stream_id, type, size)
+                    return
+            size = len(frame.content or b"")
             try:
-                self.dump_body(frame.json(), stream_id)
+                self.dump_body(frame.json(), stream_id, type, size)
             except Exception as e:
                 logging.error(e)
-                self.dump_raw(frame.content, stream_id)
+                self.dump_raw(frame.content or b"", stream_id, type)
 
     def requestheaders(self, flow: HTTPFlow) -> None:
         """If the response is streamed, buffer it and dump the complete.
@@ -47,12 +106,16 @@ class DumpBody(object):
         flow.request.stream = False
 
     def responseheaders(self, flow: HTTPFlow) -> None:
-        """If the response is streamed, buffer it and dump the complete.
+        """If the response is streamed, either pass it through and tee
+        the chunks, or buffer it and dump the complete.
 
         Args:
             flow (HTTPFlow): The flow.
         """
-        flow.response.stream = False
+        if self.stream_responses and is_event_stream(flow.response):
+            tee_response(flow)
+        else:
+            flow.response.stream = False
 
     def response(self, flow: HTTPFlow) -> None:
         """Grep the response body for the corresponding stream_id.
@@ -74,49 +137,45 @@ class DumpBody(object):
         """
         self.handle_flow(flow, type="request")
 
-    def dump_raw(self, data: bytes, stream_id: str) -> None:
-        """Dump the raw data to a file.
+    def dump_raw(self, data: bytes, stream_id: str, type: str) -> None:
+        """Dump the raw data of a body that is not JSON.
 
         Args:
             data (bytes): The raw data.
             stream_id (str): Flow id.
+            type (str): The type of flow, either request or response.
         """
         # Gemini debugging
-        compact_time_str = datetime.now().strftime("%Y%m%d%H%M%S")
-        dump_file: pathlib.Path = self.dump_path.joinpath(
-            f"raw/{compact_time_str}.txt",
-        )
-        dump_file.parent.mkdir(exist_ok=True)
-        dump_file.write_bytes(data)
-        logging.info(f"Dumping raw {stream_id} to {dump_file}")
+        logging.info(f"Dumping raw {stream_id}")
+        body = {"raw": data.decode("utf-8", errors="replace")}
+        self.dump_body(body, stream_id, type, len(data))
 
-        self.flow_data[stream_id].raw = str(dump_file)
-
-    def dump_body(self, body: json.loads, stream_id: str) -> None:
-        """Dump the body to a file. If it is a request body,
-          store the data in memory. For responses, dump the data
-          to a file and clear memory.
+    def dump_body(
+        self, body: json.loads, stream_id: str, type: str, size: int = 0
+    ) -> None:
+        """Dump the body. If it is a request body,
+          store the data in memory. For responses, hand the data
+          to the writer and clear memory.
 
         Args:
             body (json.loads): The body to dump.
             stream_id (str): The stream id.
+            type (str): The type of flow, either request or response.
+            size (int): Size of the encoded body, to bound the memory used.
         """
         time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         if body is None:
             logging.info(f"{time_str} {stream_id} None")
             body = {}
-        if self.flow_data.get(stream_id) is None:
-            self.flow_data[stream_id] = Dict()
-            self.flow_data[stream_id].request = body
+        if type == "request":
+            self.flow_data.put(stream_id, body, size)
         else:
-            self.flow_data[stream_id].response = body
-            compact_time_str = datetime.now().strftime("%Y%m%d%H%M%S")
-            dump_file: pathlib.Path = self.dump_path.joinpath(
-                f"{compact_time_str}.json"
-            )
-            logging.info(f"Dumping {stream_id} to {pathlib.Path(dump_file).absolute()}")
-            logging.info(self.flow_data[stream_id])
-            dump_file.write_text(
-                json.dumps(self.flow_data[stream_id].to_dict()),
-            )
-            del self.flow_data[stream_id]
+            # The request is None if it was evicted or expired
+            record = {
+                "id": stream_id,
+                "time": time_str,
+                "request": self.flow_data.pop(stream_id),
+                "response": body,
+            }
+            logging.info(f"Dumping {stream_id}")
+            self.writer.submit(record)
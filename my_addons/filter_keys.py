@@ -1,6 +1,7 @@
-import json
 import logging
+from typing import Any, Dict
 from mitmproxy.http import HTTPFlow
+from my_addons.body_pipeline import BodyPipeline
 
 
 class FilterKeys(object):
@@ -11,24 +12,28 @@ class FilterKeys(object):
     def __init__(self, keys=[]):
         self.keys = keys
 
+    def transform(self, flow: HTTPFlow, body: Dict[str, Any]) -> bool:
+        """Delete the attributes of the request body that are not in keys.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+            body (Dict[str, Any]): The decoded request body.
+
+        Returns:
+            bool: Whether the body changed.
+        """
+        removed = [key for key in body if key not in self.keys]
+        for key in removed:
+            del body[key]
+        if removed:
+            logging.debug(f"Filtered keys {removed}")
+        return bool(removed)
+
     def request(self, flow: HTTPFlow) -> None:
-        """Grep the request body for the corresponding stream_id.
-        If the request is streamed, buffer it and dump the complete
-        request body.
+        """Filter the request body when used as a standalone addon.
+        If the request is not a json, just pass.
 
         Args:
             flow (HTTPFlow): The request flow.
         """
-        # get content field
-        try:
-
-            data = json.loads(flow.request.content.decode("utf-8"))
-            # if not in keys, delete the attribute
-            for key in list(data.keys()):
-                if key not in self.keys:
-                    del data[key]
-
-            flow.request.content = json.dumps(data).encode("utf-8")
-        except Exception as e:
-            logging.error(e)
-            # if the request is not a json, just pass
+        BodyPipeline([self]).request(flow)
@@ -0,0 +1,100 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class FlowStore(object):
+    """Bounded store for per-flow state, keyed by flow id.
+
+    Entries are evicted oldest first once max_entries or max_bytes is
+    exceeded, and expire after ttl seconds, so flows that never get a
+    response cannot grow the proxy's memory without bound.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        max_bytes: int = 256 * 1024 * 1024,
+        ttl: float = 600,
+    ):
+        """
+        Args:
+            max_entries (int): Maximum number of flows kept.
+            max_bytes (int): Maximum total size of the flows kept.
+            ttl (float): Seconds after which a flow is dropped.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.resident_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def put(self, key: str, value: Any, size: int) -> None:
+        """Store the state of a flow.
+
+        Args:
+            key (str): The flow id.
+            value (Any): The state.
+            size (int): Approximate size of the state in bytes.
+        """
+        self.pop(key)
+        self._entries[key] = (time.monotonic(), size, value)
+        self.resident_bytes += size
+        self.expire()
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or self.resident_bytes > self.max_bytes
+        ):
+            self._drop_oldest()
+            self.evictions += 1
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        return default if entry is None else entry[2]
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        """Remove the state of a flow.
+
+        Args:
+            key (str): The flow id.
+            default (Any): Returned if the flow is not stored.
+
+        Returns:
+            Any: The state, or default if missing, evicted or expired.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self.resident_bytes -= entry[1]
+        return entry[2]
+
+    def expire(self, now: Optional[float] = None) -> None:
+        """Drop all flows older than ttl."""
+        now = time.monotonic() if now is None else now
+        # Entries are in insertion order, so the oldest come first
+        while self._entries:
+            created = next(iter(self._entries.values()))[0]
+            if now - created <= self.ttl:
+                break
+            self._drop_oldest()
+            self.expirations += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "resident_bytes": self.resident_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _drop_oldest(self) -> None:
+        _, (_, size, _) = self._entries.popitem(last=False)
+        self.resident_bytes -= size
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import ssl
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Dict, List, Optional
+
+from mitmproxy.flow import Error
+from mitmproxy.http import HTTPFlow
+from my_addons.body_pipeline import json_body
+
+BACKEND = "backend"
+
+
+class Backend(object):
+    """State of one upstream LLM server."""
+
+    def __init__(self, url: str):
+        parsed = urllib.parse.urlsplit(url)
+        self.url = url.rstrip("/")
+        self.scheme = parsed.scheme or "http"
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.scheme == "https" else 80)
+        self.outstanding = 0
+        self.latency = 1.0  # EWMA of the request duration in seconds
+        self.errors = 0  # consecutive errors
+        self.ejected_until = 0.0
+        self.healthy = True
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+
+def parse_routes(spec: str) -> Dict[str, List[str]]:
+    """Parse model routes like "llama3=http://a:11434|http://b:11434;phi3=...".
+
+    Args:
+        spec (str): The routes, models separated by ";", backends by "|".
+
+    Returns:
+        Dict[str, List[str]]: The backend urls per model name.
+    """
+    routes = {}
+    for route in filter(None, spec.split(";")):
+        model, _, urls = route.partition("=")
+        routes[model.strip()] = [url.strip() for url in urls.split("|") if url.strip()]
+    return routes
+
+
+class LoadBalancer(object):
+    """Mitmproxy addon spreading flows over a pool of upstream LLM servers.
+
+    Each flow is rewritten to the backend with the fewest outstanding
+    requests, or with strategy="latency" the lowest expected wait
+    (outstanding requests times average latency). Backends are ejected for
+    eject_for seconds after eject_after consecutive errors and health
+    checked in the background. With model_routes, requests only go to
+    the backends that serve their model, e.g. where AddModelId's model
+    is already loaded.
+    """
+
+    def __init__(
+        self,
+        backends: List[str],
+        strategy: str = "least_outstanding",
+        model_routes: Optional[Dict[str, List[str]]] = None,
+        health_path: str = "/",
+        health_interval: float = 10,
+        eject_after: int = 3,
+        eject_for: float = 30,
+    ):
+        """
+        Args:
+            backends (List[str]): Urls of the upstream servers.
+            strategy (str): Either "least_outstanding" or "latency".
+            model_routes (Dict[str, List[str]]): Backend urls per model name.
+            health_path (str): Path requested by the health checks.
+            health_interval (float): Seconds between health checks.
+            eject_after (int): Consecutive errors before a backend is ejected.
+            eject_for (float): Seconds a backend stays ejected.
+        """
+        self.backends = {url.rstrip("/"): Backend(url) for url in backends}
+        for urls in (model_routes or {}).values():
+            for url in urls:
+                self.backends.setdefault(url.rstrip("/"), Backend(url))
+        self.model_routes = {
+            model: [self.backends[url.rstrip("/")] for url in urls]
+            for model, urls in (model_routes or {}).items()
+        }
+        self.strategy = strategy
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.eject_after = eject_after
+        self.eject_for = eject_for
+        self._health_task: Optional[asyncio.Task] = None
+
+    def running(self) -> None:
+        self._health_task = asyncio.get_running_loop().create_task(
+            self._health_checks()
+        )
+
+    def done(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+
+    def request(self, flow: HTTPFlow) -> None:
+        """Rewrite the upstream of the flow to the selected backend.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+        """
+        if flow.response is not None:
+            # Answered by the proxy, e.g. from the cache
+            return
+        backend = self.select(flow)
+        if backend is None:
+            return
+        flow.request.scheme = backend.scheme
+        flow.request.host = backend.host
+        flow.request.port = backend.port
+        flow.metadata[BACKEND] = backend.url
+        backend.outstanding += 1
+
+    def response(self, flow: HTTPFlow) -> None:
+        if flow.response.status_code == 429:
+            # Shed by the admission control or the backend, not a latency sample
+            self._release(flow, failed=False, sample=False)
+            return
+        self._release(flow, failed=flow.response.status_code >= 500)
+
+    def error(self, flow: HTTPFlow) -> None:
+        self._release(flow, failed=self.upstream_failed(flow))
+
+    @staticmethod
+    def upstream_failed(flow: HTTPFlow) -> bool:
+        """Whether a flow error is the backend's fault: connect, TLS and read
+        errors count, client disconnects and flows killed by the proxy don't.
+
+        Args:
+            flow (HTTPFlow): The failed flow.
+
+        Returns:
+            bool: Whether the error counts towards ejecting the backend.
+        """
+        if flow.error is None or flow.error.msg == Error.KILLED_MESSAGE:
+            return False
+        if "client" in flow.error.msg.lower():
+            # e.g. "Client disconnected."
+            return False
+        # Only set once the proxy started connecting to the backend
+        return flow.server_conn is not None and bool(flow.server_conn.timestamp_start)
+
+    def select(self, flow: HTTPFlow) -> Optional[Backend]:
+        """Pick the backend for a flow.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+
+        Returns:
+            Optional[Backend]: The backend, None if the pool is empty.
+        """
+        body = json_body(flow) or {}
+        candidates = self.model_routes.get(body.get("model"))
+        if not candidates:
+            candidates = list(self.backends.values())
+        now = time.monotonic()
+        # Rather try an ejected backend than fail the request
+        available = [b for b in candidates if b.available(now)] or candidates
+        if not available:
+            return None
+        if self.strategy == "latency":
+            return min(available, key=lambda b: (b.outstanding + 1) * b.latency)
+        return min(available, key=lambda b: (b.outstanding, b.latency))
+
+    def _release(self, flow: HTTPFlow, failed: bool, sample: bool = True) -> None:
+        backend = self.backends.get(flow.metadata.pop(BACKEND, None))
+        if backend is None:
+            return
+        backend.outstanding -= 1
+        if failed:
+            backend.errors += 1
+            if backend.errors >= self.eject_after:
+                logging.warning(f"Ejecting backend {backend.url} for {self.eject_for}s")
+                backend.ejected_until = time.monotonic() + self.eject_for
+                backend.errors = 0
+            return
+        backend.errors = 0
+        if not sample:
+            return
+        end = flow.response.timestamp_end or time.time()
+        duration = end - flow.request.timestamp_start
+        backend.latency = 0.8 * backend.latency + 0.2 * duration
+
+    def _check(self, backend: Backend) -> bool:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        try:
+            with urllib.request.urlopen(
+                backend.url + self.health_path, timeout=5, context=context
+            ) as response:
+                return response.status < 500
+        except urllib.error.HTTPError as e:
+            return e.code < 500
+        except (OSError, ValueError):
+            return False
+
+    async def _health_checks(self) -> None:
+        while True:
+            backends = list(self.backends.values())
+            results = await asyncio.gather(
+                *(asyncio.to_thread(self._check, backend) for backend in backends)
+            )
+            for backend, healthy in zip(backends, results):
+                if healthy != backend.healthy:
+                    state = "healthy" if healthy else "unhealthy"
+                    logging.warning(f"Backend {backend.url} is {state}")
+                backend.healthy = healthy
+            await asyncio.sleep(self.health_interval)
@@ -0,0 +1,293 @@
+import asyncio
+import concurrent.futures
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from mitmproxy.http import HTTPFlow
+from my_addons.body_pipeline import json_body
+from my_addons.sse import (
+    SSE_FIRST_CHUNK,
+    is_event_stream,
+    iter_events,
+    tee_response,
+    teed_body,
+)
+
+SENT = "metrics_sent"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200)
+
+
+def escape_label(value: str) -> str:
+    """Escape a label value as the Prometheus text format requires."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def metric_name(name: str) -> str:
+    """Replace the characters not allowed in a metric name."""
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+class Histogram(object):
+    """Prometheus style cumulative histogram with one series per label set."""
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> (bucket counts, sum, count)
+        self.series: Dict[Tuple[Tuple[str, str], ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def snapshot(self) -> Dict[Tuple[Tuple[str, str], ...], tuple]:
+        """Copy of the series, to render without holding the lock."""
+        return {
+            key: (list(counts), total, count)
+            for key, (counts, total, count) in self.series.items()
+        }
+
+    def render(self, series: Optional[Dict] = None) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        series = self.series if series is None else series
+        for key, (counts, total, count) in series.items():
+            labels = ",".join(f'{k}="{escape_label(v)}"' for k, v in key)
+            sep = "," if labels else ""
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {bucket}')
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+class ProxyMetrics(object):
+    """Mitmproxy addon recording per-flow latency and throughput and
+    serving them in the Prometheus text format on a local port.
+
+    Add it last, so the time the request leaves the addon chain
+    approximates when it is sent upstream.
+    """
+
+    def __init__(
+        self,
+        port: int = 9464,
+        host: str = "127.0.0.1",
+        gauges: Optional[Dict[str, Callable[[], Dict[str, float]]]] = None,
+    ):
+        """
+        Args:
+            port (int): Port of the metrics endpoint.
+            host (str): Interface of the metrics endpoint.
+            gauges (Dict[str, Callable]): Stats of other addons to export,
+                e.g. {"completion_cache": cache.stats}.
+        """
+        self.port = port
+        self.host = host
+        self.gauges = gauges or {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.requests: Dict[Tuple[str, str], int] = {}
+        self.histograms = {
+            name: Histogram(f"proxy_{name}", help, buckets)
+            for name, help, buckets in (
+                (
+                    "overhead_seconds",
+                    "Time spent in the addon chain before going upstream.",
+                    LATENCY_BUCKETS,
+                ),
+                (
+                    "upstream_connect_seconds",
+                    "Time to open a new upstream connection.",
+                    LATENCY_BUCKETS,
+                ),
+                (
+                    "time_to_first_byte_seconds",
+                    "Time from sending the request to the response headers.",
+                    LATENCY_BUCKETS,
+                ),
+                (
+                    "time_to_first_token_seconds",
+                    "Time from sending the request to the first streamed chunk.",
+                    LATENCY_BUCKETS,
+                ),
+                (
+                    "duration_seconds",
+                    "Time from receiving the request to the end of the response.",
+                    LATENCY_BUCKETS,
+                ),
+                ("request_bytes", "Size of the request body.", BYTES_BUCKETS),
+                ("response_bytes", "Size of the response body.", BYTES_BUCKETS),
+                (
+                    "stream_tokens_per_second",
+                    "Streamed deltas per second after the first one.",
+                    RATE_BUCKETS,
+                ),
+            )
+        }
+
+    def running(self) -> None:
+        # The gauges are read on the event loop that mutates them
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+        addon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = addon.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logging.info(f"Serving proxy metrics on http://{self.host}:{self.port}/")
+
+    def done(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def request(self, flow: HTTPFlow) -> None:
+        """Mark the end of the addon chain.
+
+        Args:
+            flow (HTTPFlow): The request flow.
+        """
+        if flow.response is not None:
+            # Answered by the proxy, e.g. from the cache, never sent upstream
+            return
+        flow.metadata[SENT] = time.time()
+
+    def responseheaders(self, flow: HTTPFlow) -> None:
+        """Tee streamed responses to time the first token.
+
+        Args:
+            flow (HTTPFlow): The flow.
+        """
+        if is_event_stream(flow.response):
+            tee_response(flow)
+
+    def response(self, flow: HTTPFlow) -> None:
+        """Record the timings and sizes of a completed flow.
+
+        Args:
+            flow (HTTPFlow): The response flow.
+        """
+        body = json_body(flow) or {}
+        labels = {"model": str(body.get("model", "unknown"))}
+        request, response = flow.request, flow.response
+        sent = flow.metadata.get(SENT)
+        teed = teed_body(flow)
+        response_bytes = len(teed if teed is not None else response.raw_content or b"")
+
+        observed = [
+            ("request_bytes", len(request.raw_content or b"")),
+            ("response_bytes", response_bytes),
+        ]
+        if request.timestamp_end and response.timestamp_end:
+            observed.append(
+                ("duration_seconds", response.timestamp_end - request.timestamp_start)
+            )
+        if sent is not None:
+            # Only set for flows sent upstream, see request
+            observed.append(("overhead_seconds", sent - request.timestamp_end))
+            if response.timestamp_start:
+                observed.append(
+                    ("time_to_first_byte_seconds", response.timestamp_start - sent)
+                )
+            server = flow.server_conn
+            if (
+                server.timestamp_start
+                and server.timestamp_tcp_setup
+                and server.timestamp_start >= request.timestamp_start
+            ):
+                # Only connections opened for this flow
+                observed.append(
+                    (
+                        "upstream_connect_seconds",
+                        server.timestamp_tcp_setup - server.timestamp_start,
+                    )
+                )
+        first_chunk = flow.metadata.get(SSE_FIRST_CHUNK)
+        if sent is not None and first_chunk is not None:
+            observed.append(("time_to_first_token_seconds", first_chunk - sent))
+            tokens = sum(1 for event in iter_events(teed) if event.get("choices"))
+            generation_time = (response.timestamp_end or time.time()) - first_chunk
+            if tokens > 1 and generation_time > 0:
+                observed.append(("stream_tokens_per_second", tokens / generation_time))
+
+        status = str(response.status_code)
+        with self._lock:
+            for name, value in observed:
+                self.histograms[name].observe(value, **labels)
+            key = (labels["model"], status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def gauge_values(self) -> Dict[str, Dict[str, float]]:
+        """Current stats of the other addons, call it on the event loop."""
+        return {source: dict(stats()) for source, stats in self.gauges.items()}
+
+    async def _gauge_snapshot(self) -> Dict[str, Dict[str, float]]:
+        return self.gauge_values()
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text format.
+
+        Safe to call from the metrics server thread: the counters are copied
+        under the lock and the gauges are snapshotted on the event loop.
+        """
+        with self._lock:
+            requests = dict(self.requests)
+            histograms = [(h, h.snapshot()) for h in self.histograms.values()]
+        if self._loop is not None and self._loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(
+                self._gauge_snapshot(), self._loop
+            )
+            try:
+                gauges = future.result(timeout=5)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                logging.warning("Event loop busy, metrics without gauges")
+                gauges = {}
+        else:
+            gauges = self.gauge_values()
+
+        lines = [
+            "# HELP proxy_requests_total Completed flows.",
+            "# TYPE proxy_requests_total counter",
+        ]
+        for (model, status), count in requests.items():
+            labels = f'model="{escape_label(model)}",status="{escape_label(status)}"'
+            lines.append(f"proxy_requests_total{{{labels}}} {count}")
+        for histogram, series in histograms:
+            lines.extend(histogram.render(series))
+        for source, stats in gauges.items():
+            for name, value in stats.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                name = metric_name(f"proxy_{source}_{name}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
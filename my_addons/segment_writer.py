@@ -0,0 +1,164 @@
+import gzip
+import json
+import logging
+import pathlib
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import IO, Any, Optional
+
+
+class SegmentWriter(object):
+    """Append records as NDJSON to rotating, size-capped segment files
+    from a background thread, off the mitmproxy event loop.
+    """
+
+    def __init__(
+        self,
+        dump_path: pathlib.Path,
+        prefix: str = "dump",
+        max_bytes: int = 64 * 1024 * 1024,
+        compress: bool = False,
+        max_pending: int = 1000,
+        batch_size: int = 256,
+        flush_interval: float = 5.0,
+    ):
+        """
+        Args:
+            dump_path (pathlib.Path): Directory of the segments.
+            prefix (str): File name prefix of the segments.
+            max_bytes (int): Size on disk after which a new segment is
+                started, compressed bytes for gzipped segments.
+            compress (bool): Gzip the segments.
+            max_pending (int): Records queued before new ones are dropped.
+            batch_size (int): Records written per batch.
+            flush_interval (float): Seconds after which written records are
+                flushed to disk, readable even if the proxy is killed.
+        """
+        self.dump_path = dump_path
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.segments = 0
+
+        self._queue: "queue.Queue[Optional[Any]]" = queue.Queue(max_pending)
+        self._file: Optional[IO[bytes]] = None
+        self._raw: Optional[IO[bytes]] = None
+        self._dirty = False
+        self._flushed = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, record: Any) -> bool:
+        """Queue a record for writing without blocking the caller.
+        Drops the record when the writer falls behind.
+
+        Args:
+            record (Any): JSON serializable record.
+
+        Returns:
+            bool: Whether the record was queued.
+        """
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logging.warning(f"Dump queue full, dropped {self.dropped} records")
+            return False
+
+    def close(self) -> None:
+        """Flush all queued records and close the current segment."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _flush(self) -> None:
+        """Make everything written so far readable from disk.
+
+        A gzip segment gets its current member closed, with a valid trailer,
+        and the next write starts a new member. Concatenated members are
+        still one gzip file to readers.
+        """
+        self._flushed = time.monotonic()
+        if not self._dirty or self._raw is None:
+            return
+        if self._file is not None and self._file is not self._raw:
+            self._file.close()
+            self._file = None
+        self._raw.flush()
+        self._dirty = False
+
+    def _close_segment(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        if self._raw is not None and self._raw is not self._file:
+            self._raw.close()
+        self._file = self._raw = None
+        self._dirty = False
+
+    def _open_segment(self) -> None:
+        self._close_segment()
+        self.dump_path.mkdir(parents=True, exist_ok=True)
+        compact_time_str = datetime.now().strftime("%Y%m%d%H%M%S")
+        suffix = ".jsonl.gz" if self.compress else ".jsonl"
+        segment = self.dump_path.joinpath(
+            f"{self.prefix}-{compact_time_str}-{self.segments:04d}{suffix}"
+        )
+        self._raw = open(segment, "ab")
+        self._file = None if self.compress else self._raw
+        self.segments += 1
+        logging.info(f"Dumping to {segment.absolute()}")
+
+    def _write(self, records: list) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(json.dumps(record).encode("utf-8") + b"\n")
+            except (TypeError, ValueError) as e:
+                logging.error(e)
+        if not lines:
+            return
+        # Bytes on disk, compressed if gzipped
+        if self._raw is None or self._raw.tell() >= self.max_bytes:
+            self._open_segment()
+        if self._file is None:
+            # Only flushed every flush_interval, so it compresses across batches
+            self._file = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        self._file.write(b"".join(lines))
+        self._dirty = True
+        self.written += len(lines)
+
+    def _run(self) -> None:
+        done = False
+        while not done:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                # Idle, flush what the last batches left in the buffers
+                self._try(self._flush)
+                continue
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            self._try(self._write, batch)
+            if time.monotonic() - self._flushed >= self.flush_interval:
+                self._try(self._flush)
+        self._try(self._close_segment)
+
+    @staticmethod
+    def _try(fn, *args) -> None:
+        try:
+            fn(*args)
+        except OSError as e:
+            logging.error(e)
@@ -0,0 +1,118 @@
+import json
+import logging
+import time
+from typing import Any, Dict, Iterator, Optional
+
+from mitmproxy.http import HTTPFlow, Response
+
+SSE_CHUNKS = "sse_chunks"
+SSE_FIRST_CHUNK = "sse_first_chunk"
+
+
+def is_event_stream(response: Response) -> bool:
+    """Check if the response is a server-sent event stream."""
+    return response.headers.get("content-type", "").startswith("text/event-stream")
+
+
+def tee_response(flow: HTTPFlow) -> None:
+    """Stream the response straight through to the client while keeping
+    a copy of the chunks in the flow metadata. Safe to call from several
+    addons, the response is only tee'd once.
+
+    Args:
+        flow (HTTPFlow): The flow, in the responseheaders hook.
+    """
+    if SSE_CHUNKS in flow.metadata:
+        return
+    chunks = []
+    flow.metadata[SSE_CHUNKS] = chunks
+
+    def tee(data: bytes) -> bytes:
+        if data and not chunks:
+            flow.metadata[SSE_FIRST_CHUNK] = time.time()
+        chunks.append(data)
+        return data
+
+    flow.response.stream = tee
+
+
+def teed_body(flow: HTTPFlow) -> Optional[bytes]:
+    """The complete body of a tee'd response, None if it was not tee'd."""
+    chunks = flow.metadata.get(SSE_CHUNKS)
+    if chunks is None:
+        return None
+    return b"".join(chunks)
+
+
+def iter_events(raw: bytes) -> Iterator[Dict[str, Any]]:
+    """Parse the JSON payloads of the data lines of an SSE body.
+
+    Args:
+        raw (bytes): The event stream.
+
+    Yields:
+        Dict[str, Any]: The decoded events, without the final [DONE].
+    """
+    for line in raw.splitlines():
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        data = line[len(b"data:") :].strip()
+        if data == b"[DONE]":
+            break
+        try:
+            yield json.loads(data)
+        except json.JSONDecodeError as e:
+            logging.error(f"SSE decode error: {e}")
+
+
+def stream_complete(raw: bytes) -> bool:
+    """Whether the event stream ended with [DONE] or a finish_reason,
+    rather than being cut off."""
+    if b"[DONE]" in raw:
+        return True
+    return any(
+        choice.get("finish_reason")
+        for event in iter_events(raw)
+        for choice in event.get("choices") or []
+    )
+
+
+def assemble_completion(raw: bytes) -> Dict[str, Any]:
+    """Reassemble the chat completion chunks of an SSE body into
+    a single chat completion record.
+
+    Args:
+        raw (bytes): The event stream.
+
+    Returns:
+        Dict[str, Any]: The completion, shaped like a non-streamed response.
+    """
+    completion: Dict[str, Any] = {"object": "chat.completion", "choices": []}
+    contents: Dict[int, list] = {}
+    choices: Dict[int, Dict[str, Any]] = {}
+    for event in iter_events(raw):
+        for key in ("id", "model", "created", "usage"):
+            if event.get(key) is not None:
+                completion[key] = event[key]
+        for choice in event.get("choices") or []:
+            index = choice.get("index", 0)
+            delta = choice.get("delta") or {}
+            entry = choices.setdefault(
+                index,
+                {"index": index, "message": {"role": "assistant"}},
+            )
+            if delta.get("role"):
+                entry["message"]["role"] = delta["role"]
+            if delta.get("content"):
+                contents.setdefault(index, []).append(delta["content"])
+            if delta.get("tool_calls"):
+                entry["message"].setdefault("tool_calls", []).extend(
+                    delta["tool_calls"]
+                )
+            if choice.get("finish_reason"):
+                entry["finish_reason"] = choice["finish_reason"]
+    for index in sorted(choices):
+        choices[index]["message"]["content"] = "".join(contents.get(index, []))
+        completion["choices"].append(choices[index])
+    return completion
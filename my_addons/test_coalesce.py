@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+from mitmproxy.http import Headers
+from mitmproxy.test import tflow, tutils
+from my_addons.body_pipeline import BodyPipeline
+from my_addons.coalesce import COALESCE_KEY, Coalescer
+
+BODY = {
+    "model": "m",
+    "messages": [{"role": "user", "content": "hi"}],
+    "stream": True,
+}
+CHUNK = {"choices": [{"index": 0, "delta": {"content": "tok"}, "finish_reason": None}]}
+STREAM = [b"data: " + json.dumps(CHUNK).encode("utf-8") + b"\n\n"] * 3
+
+
+def post(body):
+    flow = tflow.tflow(
+        req=tutils.treq(
+            method=b"POST",
+            path=b"/v1beta/openai/chat/completions",
+            content=json.dumps(body).encode("utf-8"),
+        )
+    )
+    BodyPipeline([]).request(flow)
+    return flow
+
+
+def stream_leader(coalescer, flow, chunks):
+    flow.response = tutils.tresp(
+        headers=Headers(content_type="text/event-stream"), content=b""
+    )
+    coalescer.responseheaders(flow)
+    for chunk in chunks:
+        flow.response.stream(chunk)
+    coalescer.response(flow)
+
+
+def test_streaming_follower_gets_leader_stream():
+    async def run():
+        coalescer = Coalescer()
+        leader, follower = post(BODY), post(BODY)
+        await coalescer.request(leader)
+        assert leader.response is None
+        waiting = asyncio.create_task(coalescer.request(follower))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        stream_leader(coalescer, leader, STREAM + [b"data: [DONE]\n\n"])
+        await waiting
+        assert follower.response.content == b"".join(STREAM) + b"data: [DONE]\n\n"
+        assert follower.response.headers["content-type"] == "text/event-stream"
+        assert coalescer.stats()["followers"] == 1
+
+    asyncio.run(run())
+
+
+def test_truncated_stream_promotes_follower():
+    async def run():
+        coalescer = Coalescer()
+        leader, follower = post(BODY), post(BODY)
+        await coalescer.request(leader)
+        waiting = asyncio.create_task(coalescer.request(follower))
+        await asyncio.sleep(0)
+
+        # Upstream closed the stream without [DONE] or a finish_reason
+        stream_leader(coalescer, leader, STREAM)
+        await waiting
+        assert follower.response is None
+        assert COALESCE_KEY in follower.metadata
+        assert coalescer.stats()["promotions"] == 1
+
+    asyncio.run(run())
@@ -9,39 +9,62 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/code")
 from EnvConfig import EnvironmentConfig
 from LlmClient import LLMClient
-from FileManager import FileManager
+from LlmCache import LLMCache
+from FileManager import FileManager, NdjsonWriter
 from AlertProcessor import AlertProcessor
+from AlertReducer import AlertReducer
+from PromptPacker import PromptPacker, MapReduceTriage
 from EsClient import ElasticsearchClient, AlertQuery
 
 config = EnvironmentConfig()
 
 es = ElasticsearchClient(config)
-llm_client = LLMClient(config.llm_host, config.llm_token)
+# Replay completions of unchanged cases from disk
+cache = LLMCache(config.llm_cache_dir) if config.llm_cache_dir else None
+llm_client = LLMClient(config.llm_host, config.llm_token, cache=cache)
 
-case_id = "6ef42408-5c83-4c4e-bcb3-cc5aaf2bd479"
-alert_ids = es.get_alert_ids_for_case(case_id)
-query = AlertQuery.alerts_by_id(alert_ids)
+processor = AlertProcessor(None, "data/keys.txt")
 
-# size = 11
-# severity = "medium"  # "low", "medium", "critical"
-# query = AlertQuery.new_alerts(size, severity)
 index = ".internal.alerts-sec*"
+# Debug artifacts are written in the background, off the critical path
+alert_log = NdjsonWriter("data/alerts.ndjson.gz")
+# Collapse alerts of the same rule, host, user and technique
+reducer = AlertReducer(processor)
+# Only fetch the fields listed in keys.txt and the ones to group by
+keys = processor.keys + reducer.group_keys
 
-alerts = es.fetch_alerts(query, index)
-FileManager.write_json("data/alerts.json", alerts)
 
-processor = AlertProcessor("data/alerts.json", "data/keys.txt")
-processed_alerts = processor.process_alerts()
+def logged(hits):
+    for hit in hits:
+        alert_log.write(hit)
+        yield hit
+
+
+if len(sys.argv) > 1 and sys.argv[1] == "--new":
+    # python run.py --new [low|medium|critical] [size]
+    severity = sys.argv[2] if len(sys.argv) > 2 else "medium"
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 11
+    query = AlertQuery.new_alerts(size, severity, keys=keys)
+    # Reduce alerts as the pages arrive instead of after the whole result set
+    processed_alerts = reducer.reduce(logged(es.iter_alerts(query, index, limit=size)))
+else:
+    # python run.py [case_id]
+    case_id = sys.argv[1] if len(sys.argv) > 1 else "6ef42408-5c83-4c4e-bcb3-cc5aaf2bd479"
+    alert_ids = es.get_alert_ids_for_case(case_id)
+    alerts, missing_ids = es.fetch_alerts_by_id(alert_ids, index, keys=keys)
+    processed_alerts = reducer.reduce(logged(alerts))
+
+alert_log.close()
 
 base_prompt = FileManager.read_text("prompts/ifp_prompt.txt")
-formatted_prompt = AlertProcessor.format_prompt(base_prompt, processed_alerts)
 
-payload = {
-    "model": config.llm_model,
-    "messages": [{"role": "user", "content": formatted_prompt}],
-    "stream": True,
-}
-FileManager.write_json("data/payload.json", payload)
+# Split the alerts into prompts fitting the model context, see ctxLlama/Modelfile
+packer = PromptPacker(budget_tokens=71000)
+triage = MapReduceTriage(llm_client, packer, config.llm_model)
+payloads = triage.build_payloads(base_prompt, processed_alerts)
+payload_log = NdjsonWriter("data/payload.ndjson")
+payload_log.write_many(payloads)
 
-content = llm_client.send_prompt(payload)
+content = triage.run(payloads)
 FileManager.write_text("data/content.json", content)
+payload_log.close()
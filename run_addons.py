@@ -1,12 +1,56 @@
+import os
+
+from my_addons.admission import AdmissionControl
+from my_addons.body_pipeline import BodyPipeline
+from my_addons.coalesce import Coalescer
+from my_addons.completion_cache import CompletionCache
 from my_addons.dump_body import DumpBody
 from my_addons.add_modelid import AddModelId
 from my_addons.filter_keys import FilterKeys
+from my_addons.load_balancer import LoadBalancer, parse_routes
+from my_addons.metrics import ProxyMetrics
 
 MODEL_NAME = "gemini-2.0-flash"
-FILTER_KEYS = ["model", "messages"]
+# stream and stream_options must pass, or the upstream never streams back
+FILTER_KEYS = ["model", "messages", "stream", "stream_options"]
+# Comma separated upstream urls, the reverse proxy target is used if empty
+LLM_BACKENDS = [url for url in os.getenv("LLM_BACKENDS", "").split(",") if url]
+# e.g. "llama3=http://a:11434|http://b:11434;phi3=http://c:11434"
+LLM_MODEL_ROUTES = parse_routes(os.getenv("LLM_MODEL_ROUTES", ""))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Concurrent requests per upstream and model, the excess is queued
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "4"))
+
+completion_cache = CompletionCache()
+coalescer = Coalescer()
+admission = AdmissionControl(max_concurrency=MAX_CONCURRENCY)
+dump_body = DumpBody(stream_responses=True)
+
+load_balancer = []
+if LLM_BACKENDS:
+    load_balancer.append(LoadBalancer(LLM_BACKENDS, model_routes=LLM_MODEL_ROUTES))
 
 addons = [
-    FilterKeys(keys=FILTER_KEYS),
-    AddModelId(MODEL_NAME),
-    DumpBody(),
+    # Decode the request body once for all transforms and the dump
+    BodyPipeline([FilterKeys(keys=FILTER_KEYS), AddModelId(MODEL_NAME)]),
+    # Answer repeated requests without the upstream, keyed on the transformed body
+    completion_cache,
+    # Send identical concurrent requests upstream only once
+    coalescer,
+    # Spread the remaining flows over the backends
+    *load_balancer,
+    # Queue interactive clients ahead of batch triage, shed load with 429
+    admission,
+    # Stream completions through, the dump is reassembled from the SSE deltas
+    dump_body,
+    # Last, to time the flows from when they leave the addon chain
+    ProxyMetrics(
+        port=METRICS_PORT,
+        gauges={
+            "completion_cache": completion_cache.stats,
+            "coalescer": coalescer.stats,
+            "admission": admission.stats,
+            "dump_flow_store": dump_body.flow_data.stats,
+        },
+    ),
 ]
@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+import urllib3
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+#  add directory to sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/code")
+from EnvConfig import EnvironmentConfig
+from LlmClient import LLMClient
+from LlmCache import LLMCache
+from FileManager import FileManager
+from AlertProcessor import AlertProcessor
+from EsClient import ElasticsearchClient
+from PromptPacker import PromptPacker
+from TriagePipeline import TriagePipeline
+
+parser = argparse.ArgumentParser(description="Triage many Kibana cases.")
+parser.add_argument("case_ids", nargs="*", help="IDs of the cases to triage.")
+parser.add_argument("--file", type=str, help="File with one case ID per line.")
+parser.add_argument(
+    "--search",
+    type=str,
+    metavar="STATUS",
+    help="Triage all Kibana cases with this status, e.g. open.",
+)
+parser.add_argument("--prompt", type=str, default="prompts/ifp_prompt.txt")
+parser.add_argument(
+    "--reduce-prompt",
+    type=str,
+    help="Prompt to merge the verdicts of cases split into several batches.",
+)
+parser.add_argument("--context", type=int, default=71000, help="Model context size.")
+parser.add_argument("--keys", type=str, default="data/keys.txt")
+parser.add_argument(
+    "--group-keys",
+    type=str,
+    help="Comma separated fields identifying duplicate alerts.",
+)
+parser.add_argument("--out", type=str, default="data/cases")
+parser.add_argument("--kibana-workers", type=int, default=4)
+parser.add_argument("--es-workers", type=int, default=4)
+parser.add_argument("--format-workers", type=int, default=2)
+parser.add_argument("--llm-workers", type=int, default=2)
+args = parser.parse_args()
+
+config = EnvironmentConfig()
+
+es = ElasticsearchClient(config)
+# Replay completions of unchanged cases from disk
+cache = LLMCache(config.llm_cache_dir) if config.llm_cache_dir else None
+llm_client = LLMClient(config.llm_host, config.llm_token, cache=cache)
+
+case_ids = list(args.case_ids)
+if args.file:
+    case_ids += FileManager.read_text(args.file).split()
+if args.search:
+    case_ids += es.find_case_ids(status=args.search)
+if not case_ids:
+    parser.error("No case IDs given, use arguments, --file or --search.")
+
+reduce_prompt = None
+if args.reduce_prompt:
+    reduce_prompt = FileManager.read_text(args.reduce_prompt)
+
+pipeline = TriagePipeline(
+    es,
+    llm_client,
+    AlertProcessor(None, args.keys),
+    FileManager.read_text(args.prompt),
+    config.llm_model,
+    out_dir=args.out,
+    kibana_workers=args.kibana_workers,
+    es_workers=args.es_workers,
+    format_workers=args.format_workers,
+    llm_workers=args.llm_workers,
+    packer=PromptPacker(budget_tokens=args.context),
+    reduce_prompt=reduce_prompt,
+    group_keys=args.group_keys.split(",") if args.group_keys else None,
+)
+results = pipeline.run(case_ids)
+failed = [case_id for case_id, status in results.items() if status.startswith("error")]
+print(f"Triaged {len(results) - len(failed)} of {len(results)} cases")